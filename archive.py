@@ -0,0 +1,147 @@
+'''
+Archive of the old messages of the rooms
+
+The retention policy of a room (a max age and/or a max number of messages, see the
+retention_policies table in db.py) says which of its messages are expired. The Archiver
+thread moves the expired messages out of the messages table into compressed segments:
+gzip JSONL files with a range of offsets of a room, indexed in the archive_segments table.
+
+The messages table (and everything that scans it, like the startup load) only keeps
+the recent messages, but nothing is lost: DB.get_room_messages_since reads the archived
+ranges back when a client asks for them.
+
+The newest message of a room is never archived: the next offset of a room is the
+highest offset in the messages table plus one.
+'''
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_INTERVAL = 60         # Seconds between two runs of the Archiver
+ARCHIVE_SEGMENT_SIZE = 5000   # Max messages per segment file (and per archiving transaction)
+ARCHIVE_PAUSE = 0.05          # Seconds between two segments, so the message writer is not starved
+ARCHIVE_CACHE_SEGMENTS = 8    # Decompressed segments kept in memory
+
+
+class Archive:
+    ''' The segment files of every room, in `directory`
+
+    Every line of a segment is a message as [offset, username, content, timestamp] '''
+    def __init__(self, directory, cache_segments=ARCHIVE_CACHE_SEGMENTS):
+        self.directory = directory
+        self.cache_segments = cache_segments
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # A dict with paths as keys and their rows, least recently used first
+
+    def write(self, room, rows):
+        ''' Writes the rows, (offset, username, content, timestamp) tuples sorted by offset, in a new
+        segment of the room. Returns its path, relative to the directory of the archive '''
+        path = os.path.join(urllib.parse.quote(room, safe=''), f'{rows[0][0]:012d}-{rows[-1][0]:012d}.jsonl.gz')
+        full_path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # Written aside and renamed, so a segment file is either complete or not there
+        tmp_path = full_path + '.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            for offset, username, content, timestamp in rows:
+                f.write(json.dumps([offset, username, content, timestamp.isoformat()], ensure_ascii=False))
+                f.write('\n')
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, full_path)
+        return path
+
+    def read(self, path):
+        ''' The rows of a segment, as (offset, username, content, timestamp) tuples '''
+        with self._lock:
+            rows = self._cache.get(path)
+            if rows is not None:
+                self._cache.move_to_end(path)
+                return rows
+        with gzip.open(os.path.join(self.directory, path), 'rt', encoding='utf-8') as f:
+            rows = [(offset, username, content, datetime.fromisoformat(timestamp))
+                    for offset, username, content, timestamp in map(json.loads, f)]
+        with self._lock:
+            self._cache[path] = rows
+            while len(self._cache) > self.cache_segments:
+                self._cache.popitem(last=False)
+        return rows
+
+    def discard(self, path):
+        ''' Removes a segment that is not indexed (its transaction failed, or its room was deleted) '''
+        with self._lock:
+            self._cache.pop(path, None)
+        try:
+            os.remove(os.path.join(self.directory, path))
+        except OSError:
+            pass
+
+
+class Archiver:
+    ''' Background job that moves the expired messages of every room to the archive
+
+    `default_policy` is the (max_age, max_count) of the rooms without a policy of their own
+    (None means no limit). Several processes can run it on the same DB, every segment is
+    indexed in a transaction that holds the DB write lock '''
+    def __init__(self, db, default_policy=(None, None), interval=ARCHIVE_INTERVAL):
+        self.db = db
+        self.default_policy = default_policy
+        self.interval = interval
+        self.archived = 0  # Messages archived by this process
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='archiver', daemon=True)
+
+    def start(self):
+        if not self._thread.is_alive() and not self._stopped.is_set():
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def run_once(self):
+        ''' Archives the expired messages of every room, returns how many '''
+        policies = self.db.get_retention_policies()
+        rooms = policies.keys() if self.default_policy == (None, None) else self.db.get_rooms()
+        archived = 0
+        for room in rooms:
+            max_age, max_count = policies.get(room, self.default_policy)
+            if max_age is None and max_count is None:
+                continue
+            try:
+                archived += self._archive_room(room, max_age, max_count)
+            except Exception as e:
+                # Only this room is skipped, the others are still archived
+                log.error('Error archiving the messages of room %s: %s', room, e)
+        self.archived += archived
+        return archived
+
+    def _archive_room(self, room, max_age, max_count):
+        archived = 0
+        upto = self.db.get_archive_cutoff(room, max_age, max_count)
+        while upto is not None and not self._stopped.is_set():
+            count = self.db.archive_messages(room, upto)
+            if not count:
+                break
+            archived += count
+            self._stopped.wait(ARCHIVE_PAUSE)
+        return archived
+
+    def _run(self):
+        while not self._stopped.is_set():
+            start = time.monotonic()
+            try:
+                archived = self.run_once()
+                if archived:
+                    log.info('Archived %s messages in %.2fs', archived, time.monotonic() - start)
+            except Exception as e:
+                log.error('Error archiving messages: %s', e)
+            self._stopped.wait(self.interval)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+'''
+This is the asyncio version of server.py, to be run under an ASGI server:
+
+    hypercorn asgi_server:app
+
+It serves the same routes with the same caches (the logic of every route is shared
+with server.py), but anything that may touch the DB runs in a bounded thread pool so
+the event loop never blocks. Long-polling and streaming clients are just idle
+coroutines instead of a thread each, so a single process can hold tens of thousands of them.
+
+To use several worker processes they have to share their state through the DB:
+
+    ZERO_CHAT_BACKEND=sqlite hypercorn --workers 4 asgi_server:app
+
+(see backend.py, the same goes for running this and server.py on the same DB)
+'''
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, Response, jsonify, request, make_response, abort, g
+
+import formats
+import metrics
+import server
+from server import (NOT_FOUND_ERROR, ALREADY_EXISTS_ERROR, UNPROCESSABLE_ENTITY_ERROR,
+                    INTERNAL_SERVER_ERROR, SERVICE_UNAVAILABLE_ERROR, UNAUTHORIZED_ERROR, TOO_MANY_REQUESTS_ERROR,
+                    STREAM_KEEPALIVE)
+
+DB_WORKERS = 16  # Max threads running DB calls at the same time
+
+log = logging.getLogger(__name__)
+
+app = Quart(__name__)
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+
+async def run_db(function, *args):
+    ''' Runs a function that uses the DB in the executor and waits for it '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(function, *args))
+
+
+@app.before_serving
+async def init():
+    log.info("Initializing the cache...")
+    if not await run_db(server.init_cache):
+        raise RuntimeError('ERROR INITIALIZING CACHE...')
+
+@app.after_serving
+async def shutdown():
+    server.backend.stop()
+    server.archiver.stop()
+    db_executor.shutdown(wait=True)
+    server.db.close()
+
+
+async def cached_response(key, variant, build):
+    ''' A JSON response (or a 304) for a resource of the response_cache, see server.py '''
+    etag, body = server.cached_body(key, variant, build, request.headers.get('If-None-Match'))
+    if body is None:
+        return Response(b'', status=304, headers={'ETag': etag})
+    return Response(body, mimetype='application/json', headers={'ETag': etag})
+
+def wire_format():
+    return formats.negotiate(request.accept_mimetypes, request.accept_encodings)
+
+async def cached_encoded_response(key, variant, build, wire):
+    ''' A response (or a 304) in a negotiated format, see server.py. Built in the executor '''
+    etag, encoded = await run_db(server.cached_encoded_body, key, variant, build, wire,
+                                 request.headers.get('If-None-Match'))
+    if encoded is None:
+        return Response(b'', status=304, headers=formats.response_headers(etag))
+    body, coding = encoded
+    return Response(body, mimetype=formats.MEDIA_TYPES[wire[0]], headers=formats.response_headers(etag, coding))
+
+
+### Metrics ###
+def request_route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+async def start_request():
+    g.request_start = time.perf_counter()
+    server.REQUESTS_IN_FLIGHT.inc(route=request_route())
+
+@app.after_request
+async def finish_request(response):
+    server.REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, route=request_route(),
+                                   method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+async def end_request(error=None):
+    server.REQUESTS_IN_FLIGHT.dec(route=request_route())
+
+@app.route("/metrics")
+async def metrics_endpoint():
+    ''' The metrics of the server in the Prometheus text format '''
+    # The collectors read the DB stats
+    return Response(await run_db(metrics.REGISTRY.render), mimetype='text/plain; version=0.0.4')
+
+@app.route("/profile/start", methods=['POST'])
+async def profile_start():
+    ''' Starts the sampling profiler, see server.py '''
+    return jsonify(server.start_profiler(request.args))
+
+@app.route("/profile/stop", methods=['POST'])
+async def profile_stop():
+    return jsonify(await run_db(server.stop_profiler))
+
+@app.route("/profile")
+async def profile():
+    return Response(server.profiler_report(request.args), mimetype='text/plain')
+
+
+@app.route("/")
+async def root():
+    return "These are not the messages you are looking for..."
+
+### Users ###
+@app.route("/user/list")
+async def list_users():
+    ''' List all the existing users '''
+    return await cached_response(server.USERS_KEY, '', lambda: server.dumps(server.all_users()))
+
+@app.route("/user/create/<username>", methods=['POST'])
+async def create_user(username):
+    ''' Creates the user received as a parameter in the URL '''
+    return jsonify(await run_db(server.add_user, username))
+
+@app.route("/user/delete/<username>")
+async def delete_user(username):
+    ''' Deletes the username from the database '''
+    return jsonify(await run_db(server.remove_user, username))
+
+### Joined Rooms ###
+@app.route("/joined_room/join/<roomname>")
+async def join_room(roomname):
+    ''' Join the room '''
+    return jsonify(await run_db(server.add_to_room, server.username_arg(request.args), roomname))
+
+@app.route("/joined_room/list/<username>")
+async def list_joined_rooms(username):
+    ''' List the rooms the user has joined '''
+    return jsonify(await run_db(server.user_rooms, username))
+
+@app.route("/joined_room/leave/<roomname>")
+async def leave_room(roomname):
+    return jsonify(await run_db(server.remove_from_room, server.username_arg(request.args), roomname))
+
+@app.route("/joined_room/all")
+async def list_all_rooms():
+    return await cached_response(server.MEMBERSHIPS_KEY, '', lambda: server.dumps(server.all_memberships()))
+
+### Rooms ###
+@app.route("/room/list")
+async def list_rooms():
+    ''' List all the existing rooms '''
+    return await cached_response(server.ROOMS_KEY, '', lambda: server.dumps(server.all_rooms()))
+
+@app.route("/room/create/<roomname>", methods=['POST'])
+async def create_room(roomname):
+    ''' Creates the room received as a parameter in the URL '''
+    return jsonify(await run_db(server.add_room, roomname))
+
+@app.route("/room/delete/<roomname>")
+async def delete_room(roomname):
+    ''' Deletes the room from the database '''
+    return jsonify(await run_db(server.remove_room, roomname))
+
+@app.route("/room/retention/<roomname>", methods=['GET', 'POST'])
+async def retention(roomname):
+    ''' Gets (GET) or sets (POST) the retention policy of the room, see server.py '''
+    if request.method == 'POST':
+        return jsonify(await run_db(server.set_room_retention, roomname, await request.get_json(silent=True)))
+    return jsonify(await run_db(server.room_retention, roomname))
+
+### Messages ###
+@app.route("/message/get/<roomname>")
+async def get_messages(roomname):
+    ''' Gets the messages from a room, same query params as in server.py (since, limit, wait) '''
+    since, limit, wait = server.get_messages_args(roomname, request.args)
+    if wait and not server.has_messages_after(roomname, since):
+        await server.broker.wait_async(roomname, lambda: server.has_messages_after(roomname, since), wait)
+    # Building the body may need the DB if the messages are not cached
+    return await cached_encoded_response(server.messages_key(roomname), server.messages_variant(since, limit),
+                                         lambda fmt: server.messages_body(roomname, since, limit, fmt), wire_format())
+
+@app.route("/message/get_many", methods=['POST'])
+async def get_many_messages():
+    ''' Gets the messages from many rooms in one request, same body and query params as in server.py '''
+    rooms, limit = server.get_many_args(server.json_body(await request.get_json(silent=True)), request.args)
+    wire = wire_format()
+    body, coding = await run_db(server.many_messages_payload, rooms, limit, wire)
+    return Response(body, mimetype=formats.MEDIA_TYPES[wire[0]], headers=formats.response_headers(coding=coding))
+
+@app.route("/message/search")
+async def search():
+    ''' Full text search of the messages, same query params as in server.py '''
+    return jsonify(await run_db(server.search_messages, server.search_args(request.args)))
+
+@app.route("/message/stream")
+async def stream_messages():
+    ''' Pushes the new messages of some rooms as Server-Sent Events, see server.py '''
+    subscriber = server.broker.subscribe_async(server.stream_rooms_arg(request.args))
+
+    async def events():
+        try:
+            yield server.STREAM_START.encode()
+            while not subscriber.closed:
+                message = await subscriber.get(timeout=STREAM_KEEPALIVE)
+                if subscriber.closed:
+                    break
+                if message is None:
+                    yield server.STREAM_KEEPALIVE_EVENT.encode()
+                    continue
+                yield server.message_event(message).encode()
+            yield server.STREAM_DISCONNECT_EVENT.encode()
+        finally:
+            server.broker.unsubscribe(subscriber)
+
+    response = await make_response(events(), {'Content-Type': 'text/event-stream',
+                                              'Cache-Control': 'no-cache',
+                                              'X-Accel-Buffering': 'no'})
+    response.timeout = None  # Streams are held open for as long as the client wants
+    return response
+
+async def wait_stored(pendings):
+    ''' Waits (up to SEND_TIMEOUT) until the messages are committed, see server.py '''
+    try:
+        await asyncio.wait_for(asyncio.gather(*(asyncio.wrap_future(pending.future) for pending in pendings)),
+                               server.SEND_TIMEOUT)
+    except asyncio.TimeoutError:
+        abort(SERVICE_UNAVAILABLE_ERROR)
+
+@app.route("/message/send/<roomname>", methods=['GET', 'POST'])
+async def send_message(roomname):
+    ''' Send a message, same query params as in server.py (durable) '''
+    body = server.json_body(await request.get_json(silent=True))
+    # Takes the room locks, which can be held across a DB write: never on the event loop
+    pending = await run_db(server.queue_message, body.get("message"))
+    if server.durable_arg(request.args):
+        await wait_stored([pending])
+    return jsonify(server.message_sent(pending))
+
+@app.route("/message/send_many", methods=['POST'])
+async def send_many_messages():
+    ''' Send many messages in one request, same body and query params as in server.py '''
+    body = server.json_body(await request.get_json(silent=True))
+    pendings = await run_db(server.queue_messages, body.get("messages"))
+    if server.durable_arg(request.args):
+        await wait_stored(pendings)
+    return jsonify(server.many_sent(pendings))
+
+### Cache ###
+@app.route("/cache/stats")
+async def cache_stats():
+    ''' Size and hit/miss counters of the messages and responses caches '''
+    return jsonify(await run_db(server.all_cache_stats))
+
+@app.route("/db/stats")
+async def db_stats():
+    ''' Connection pool and message writer metrics '''
+    return jsonify(await run_db(server.db.stats))
+
+
+### Error Handlers ###
+async def error_response(error):
+    return jsonify({'code': error.code, 'description': error.description}), error.code
+
+for code in (NOT_FOUND_ERROR, ALREADY_EXISTS_ERROR, UNPROCESSABLE_ENTITY_ERROR,
+             INTERNAL_SERVER_ERROR, SERVICE_UNAVAILABLE_ERROR, UNAUTHORIZED_ERROR):
+    app.register_error_handler(code, error_response)
+
+@app.errorhandler(TOO_MANY_REQUESTS_ERROR)
+async def error_too_many_requests(error):
+    return (jsonify({'code': error.code, 'description': error.description}), TOO_MANY_REQUESTS_ERROR,
+            {'Retry-After': str(error.retry_after)})
+
+
+if __name__ == '__main__':
+    app.run()
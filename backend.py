@@ -0,0 +1,127 @@
+'''
+Backends to share the state of the server between processes
+
+All the state that makes the server fast (users, rooms, memberships, messages and
+the offsets of every room) lives in memory, in module globals of server.py.
+A backend decides how that state is kept in sync when there is more than one process:
+
+LocalBackend: a single process, the memory is the source of truth (the default)
+
+SQLiteFeedBackend: N processes (or machines sharing the file) on the same DB.
+  - Offsets are handed out by the DB writer inside the write transaction, so two
+    processes can never use the same offset (see db.MessageWriter)
+  - Every change is logged in the events table and a thread in every process polls
+    it to apply the changes made by the others to its own caches.
+    Messages are always applied from the feed (also the ones sent by this process, the
+    writer wakes the poller up right after committing them) so every process sees the
+    messages of a room in offset order
+'''
+import logging
+import os
+import socket
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05     # Max seconds between two reads of the events table
+EVENTS_RETENTION = 300   # Seconds the events are kept before being pruned
+PRUNE_INTERVAL = 60      # Seconds between two prunes
+
+
+class LocalBackend:
+    ''' Nothing to share: there is only one server process '''
+    shared = False
+
+    def __init__(self, db):
+        self.db = db
+
+    def begin_snapshot(self):
+        ''' Called before the caches are loaded from the DB '''
+        pass
+
+    def start(self, on_event):
+        ''' Called once the caches are loaded, `on_event(event)` applies a change made elsewhere '''
+        pass
+
+    def publish(self, kind, roomname=None, username=None):
+        ''' Lets the other processes know about a change in users, rooms or memberships '''
+        pass
+
+    def notify(self, message):
+        ''' Called by the DB writer once one of our messages is committed '''
+        pass
+
+    def stop(self):
+        pass
+
+
+class SQLiteFeedBackend(LocalBackend):
+    ''' Shares the state with the other processes using the same DB through the events table '''
+    shared = True
+
+    def __init__(self, db, poll_interval=POLL_INTERVAL):
+        super().__init__(db)
+        self.origin = f'{socket.gethostname()}:{os.getpid()}'
+        self.poll_interval = poll_interval
+        self.last_event_id = 0
+        self.on_event = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='event-feed', daemon=True)
+        # From now on the writer hands out the offsets and logs the messages
+        db.message_writer.origin = self.origin
+
+    def begin_snapshot(self):
+        # Whatever happens after this is replayed from the feed (applying it twice is harmless)
+        self.last_event_id = self.db.get_last_event_id()
+
+    def start(self, on_event):
+        self.on_event = on_event
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def publish(self, kind, roomname=None, username=None):
+        self.db.add_event(self.origin, kind, roomname, username)
+
+    def notify(self, message):
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        last_prune = 0
+        while not self._stopped.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            self._poll()
+            if time.time() - last_prune > PRUNE_INTERVAL:
+                self.db.prune_events(time.time() - EVENTS_RETENTION)
+                last_prune = time.time()
+
+    def _poll(self):
+        events = self.db.get_events_since(self.last_event_id)
+        while events:
+            for event in events:
+                self.last_event_id = event.id
+                # Our own changes to users, rooms and memberships are already applied
+                if event.kind != 'message' and event.origin == self.origin:
+                    continue
+                try:
+                    self.on_event(event)
+                except Exception as e:
+                    log.error('Error applying event %s: %s', event, e)
+            events = self.db.get_events_since(self.last_event_id)
+
+
+BACKENDS = {'local': LocalBackend, 'sqlite': SQLiteFeedBackend}
+
+def make_backend(name, db):
+    ''' Creates the backend called `name` (one of BACKENDS) '''
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown state backend {name}, use one of {", ".join(BACKENDS)}')
+    return BACKENDS[name](db)
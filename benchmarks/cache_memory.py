@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+Memory used by the cached messages: Message tuples (what the cache used to keep, plus
+their encoded JSON) against the columnar RoomCache of cache.py
+
+    python benchmarks/cache_memory.py [--messages 100000] [--users 50] [--content-size 80]
+
+Memory is measured with tracemalloc, so it counts every allocated object (strings,
+datetimes, tuples, arrays...) but not the interpreter itself
+'''
+import argparse
+import os
+import random
+import string
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cache import RoomCache, UsernameTable, encode_message  # noqa: E402
+from db import Message  # noqa: E402
+
+
+def make_messages(count, users, content_size):
+    ''' Random messages of a room, the strings are built like the ones read from the DB (one object each) '''
+    usernames = [f'user_{i}' for i in range(users)]
+    start = datetime.now() - timedelta(days=1)
+    for offset in range(count):
+        content = ''.join(random.choices(string.ascii_letters + ' ', k=random.randint(1, 2 * content_size)))
+        yield Message(offset=offset, roomname='room', username=''.join(random.choice(usernames)),
+                      content=content, timestamp=start + timedelta(seconds=offset, microseconds=offset))
+
+
+def measure(build, messages):
+    ''' Bytes allocated by `build(messages)` that are still alive once it returns '''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(messages)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def tuples(messages):
+    ''' The old cache: a Message with a datetime per message and its encoded JSON '''
+    kept = [], []
+    for message in messages:
+        kept[0].append(message)
+        kept[1].append(encode_message(message))
+    return kept
+
+
+def columns(messages):
+    room_cache = RoomCache('room', UsernameTable(), capacity=sys.maxsize, complete=True)
+    for message in messages:
+        room_cache.append(message)
+    return room_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--content-size', type=int, default=80, help='Mean length of the content of a message')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = {}
+    for name, build in (('tuples', tuples), ('columns', columns)):
+        random.seed(args.seed)  # The same messages for both
+        results[name] = measure(build, make_messages(args.messages, args.users, args.content_size))
+
+    for name, nbytes in results.items():
+        print(f'{name:>8}: {nbytes / 2**20:8.2f} MiB  {nbytes / args.messages:7.1f} bytes/message')
+    print(f'   ratio: {results["tuples"] / results["columns"]:8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+'''
+Load test of the chat API
+
+Seeds a DB with users, rooms (with members) and messages, starts the server on it and
+measures throughput and latency (p50/p99) of the main operations with concurrent clients:
+
+    startup     time to open the DB and load the caches (init_cache)
+    send        /message/send/<room>
+    poll        /message/get/<room>?since=<a recent offset>
+    join/leave  /joined_room/join/<room> and /joined_room/leave/<room>
+    mixed       all of the above at the same time (the clients are split among them), reported
+                as `mixed <operation>`: the sends then overlap the joins and leaves of the same rooms
+
+Two modes:
+    client  the routes of server.py are called in this process through Flask's test client
+            (no sockets, measures the server code itself)
+    http    the server runs in its own process (server.py or asgi_server.py under hypercorn)
+            and the clients talk real HTTP to it
+
+    python benchmarks/load.py --mode client --users 1000 --rooms 100 --messages 100000
+    python benchmarks/load.py --mode http --server asgi --clients 32 --output after.json --compare before.json
+
+The results are printed and, with --output, saved as JSON. --compare prints the change
+against the results of a previous run
+'''
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import db as chat_db  # noqa: E402
+
+SEED_BATCH = 10000       # Rows per executemany when seeding
+POLL_WINDOW = 50         # Polls ask for (up to) the last POLL_WINDOW messages of a room
+SERVER_START_TIMEOUT = 120
+WORKLOAD_TIMEOUT = 600   # Seconds a workload may run before the server is taken for deadlocked
+
+
+### Seeding ###
+def seed(path, users, rooms, members, messages, seed_value):
+    ''' Creates the DB in `path` and fills it, returns {room: [members]} '''
+    rng = random.Random(seed_value)
+    usernames = [f'user_{i}' for i in range(users)]
+    roomnames = [f'room_{i}' for i in range(rooms)]
+    memberships = {room: rng.sample(usernames, min(members, users)) for room in roomnames}
+    database = chat_db.DB(path)
+    with database.pool.writer() as con:
+        with con:
+            con.executemany('INSERT OR IGNORE INTO users (name) VALUES (?)', [(user,) for user in usernames])
+            con.executemany('INSERT OR IGNORE INTO rooms (name) VALUES (?)', [(room,) for room in roomnames])
+            con.executemany('INSERT OR IGNORE INTO joined_rooms (username, roomname) VALUES (?, ?)',
+                            [(user, room) for room, room_users in memberships.items() for user in room_users])
+        start = datetime.now() - timedelta(seconds=messages)
+        offsets = dict.fromkeys(roomnames, -1)
+        batch = []
+        for i in range(messages):
+            room = rng.choice(roomnames)
+            offsets[room] += 1
+            batch.append((offsets[room], room, rng.choice(memberships[room]),
+                          f'seeded message {i} ' + 'x' * rng.randint(0, 100), start + timedelta(seconds=i)))
+            if len(batch) == SEED_BATCH or i == messages - 1:
+                with con:
+                    con.executemany(chat_db.INSERT_MESSAGE, batch)
+                batch = []
+    database.close()
+    return memberships
+
+
+def load_memberships(path):
+    database = chat_db.DB(path)
+    memberships = {}
+    for room, user in database.get_all_joined_users():
+        memberships.setdefault(room, []).append(user)
+    database.close()
+    return memberships
+
+
+### Clients ###
+class TestClient:
+    ''' Calls the routes of server.py in this process '''
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        return self.client.open(path, method=method, json=body).status_code
+
+
+class HTTPClient:
+    ''' Calls the routes of a server listening on `url` '''
+    def __init__(self, url):
+        self.url = url
+
+    def request(self, method, path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(self.url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+### Workloads ###
+# Every workload is a function (client, rng, memberships, offsets, partition) -> [(operation, status, seconds)]
+# `partition` is (index of the client, number of clients), for workloads that must not collide with each other
+def timed(client, operation, method, path, body=None):
+    start = time.perf_counter()
+    status = client.request(method, path, body)
+    return operation, status, time.perf_counter() - start
+
+def send(client, rng, memberships, offsets, partition):
+    room = rng.choice(list(memberships))
+    message = {'username': rng.choice(memberships[room]), 'roomname': room,
+               'content': 'benchmark message ' + 'x' * rng.randint(0, 100), 'timestamp': time.time()}
+    return [timed(client, 'send', 'POST', f'/message/send/{room}', {'message': message})]
+
+def poll(client, rng, memberships, offsets, partition):
+    room = rng.choice(list(memberships))
+    since = max(offsets.get(room, -1) - rng.randint(1, POLL_WINDOW), -1)
+    return [timed(client, 'poll', 'GET', f'/message/get/{room}?since={since}')]
+
+def join_leave(client, rng, memberships, offsets, partition):
+    # A user that is not in the room, joined and left right away so the memberships do not change.
+    # Every client has users of its own, two clients joining the same user to the same room would fail
+    index, count = partition
+    mine = sorted({user for users in memberships.values() for user in users})[index::count]
+    room = rng.choice(list(memberships))
+    if not mine:
+        return []
+    username = rng.choice(mine)
+    if username in memberships[room]:
+        return []
+    return [timed(client, 'join', 'GET', f'/joined_room/join/{room}?username={username}'),
+            timed(client, 'leave', 'GET', f'/joined_room/leave/{room}?username={username}')]
+
+WORKLOADS = {'send': send, 'poll': poll, 'join_leave': join_leave}
+MIXED = 'mixed'  # Every workload at the same time
+
+
+def run_workload(workloads, make_client, clients, requests, memberships, offsets, seed_value):
+    ''' Runs `requests` iterations of every workload at the same time over `clients` threads
+    (split among the workloads, at least one each), returns (samples, seconds) '''
+    samples = []
+    lock = threading.Lock()
+    clients = max(clients, len(workloads))
+    assigned = [workloads[i % len(workloads)] for i in range(clients)]
+
+    def worker(i):
+        client = make_client()
+        rng = random.Random(seed_value * 1000 + i)
+        workload = assigned[i]
+        mine = []
+        for _ in range(math.ceil(requests / assigned.count(workload))):
+            mine.extend(workload(client, rng, memberships, offsets, (i, clients)))
+        with lock:
+            samples.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(start + WORKLOAD_TIMEOUT - time.perf_counter(), 0))
+    if any(thread.is_alive() for thread in threads):
+        raise RuntimeError(f'The workload did not finish in {WORKLOAD_TIMEOUT}s, the server may be deadlocked')
+    return samples, time.perf_counter() - start
+
+
+def percentile(values, q):
+    ''' The q-th (0 to 1) percentile of sorted values '''
+    return values[min(int(round(q * (len(values) - 1))), len(values) - 1)] if values else None
+
+def summarize(latencies, seconds, errors=0):
+    latencies = sorted(latencies)
+    return {'count': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / seconds if seconds else None,
+            'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else None,
+            'p50_ms': 1000 * percentile(latencies, 0.50) if latencies else None,
+            'p99_ms': 1000 * percentile(latencies, 0.99) if latencies else None,
+            'max_ms': 1000 * latencies[-1] if latencies else None}
+
+def summarize_samples(samples, seconds):
+    results = {}
+    for operation in sorted({operation for operation, _, _ in samples}):
+        mine = [(status, latency) for op, status, latency in samples if op == operation]
+        results[operation] = summarize([latency for _, latency in mine], seconds,
+                                       errors=sum(1 for status, _ in mine if not 200 <= status < 400))
+    return results
+
+
+### Modes ###
+def run_client_mode(args, workdir, memberships):
+    ''' Imports server.py in this process and drives it with test clients '''
+    os.chdir(workdir)  # server.py opens the DB in db/ relative to the working directory
+    start = time.perf_counter()
+    import server
+    import_seconds = time.perf_counter() - start
+    startup = []
+    for _ in range(args.startup_runs):
+        start = time.perf_counter()
+        if not server.init_cache():
+            raise RuntimeError('init_cache failed')
+        startup.append(time.perf_counter() - start)
+    results = {'import': summarize([import_seconds], import_seconds),
+               'startup': summarize(startup, sum(startup))}
+    results.update(run_workloads(args, lambda: TestClient(server.app), memberships, lambda: dict(server.room_offsets)))
+    server.db.close()
+    return results
+
+
+def server_command(args, port):
+    if args.server == 'asgi':
+        return [sys.executable, '-m', 'hypercorn', 'asgi_server:app', '--bind', f'127.0.0.1:{port}']
+    # Not `./server.py`, it runs with the debugger and the reloader
+    return [sys.executable, '-c', 'import server\n'
+                                  'if not server.init_cache(): exit(1)\n'
+                                  f'server.app.run(port={port}, threaded=True)']
+
+def run_http_mode(args, workdir, memberships):
+    ''' Starts the server in its own process and drives it over HTTP '''
+    url = f'http://127.0.0.1:{args.port}'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    results = {}
+    startup = []
+    for run in range(args.startup_runs):
+        start = time.perf_counter()
+        process = subprocess.Popen(server_command(args, args.port), cwd=workdir, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        while not server_ready(url):
+            if process.poll() is not None or time.perf_counter() - start > SERVER_START_TIMEOUT:
+                process.kill()
+                raise RuntimeError(f'The server did not start, try running: {" ".join(server_command(args, args.port))}')
+            time.sleep(0.01)
+        startup.append(time.perf_counter() - start)
+        if run < args.startup_runs - 1:
+            process.terminate()
+            process.wait()
+    try:
+        results['startup'] = summarize(startup, sum(startup))
+        offsets = load_offsets(workdir)
+        results.update(run_workloads(args, lambda: HTTPClient(url), memberships, lambda: offsets))
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+def server_ready(url):
+    try:
+        return HTTPClient(url).request('GET', '/') == 200
+    except (urllib.error.URLError, ConnectionError):
+        return False
+
+def load_offsets(workdir):
+    database = chat_db.DB(os.path.join(workdir, chat_db.DB_PATH))
+    offsets = database.get_last_offsets()
+    database.close()
+    return offsets
+
+def run_workloads(args, make_client, memberships, get_offsets):
+    results = {}
+    for name in args.workloads:
+        workloads = list(WORKLOADS.values()) if name == MIXED else [WORKLOADS[name]]
+        samples, seconds = run_workload(workloads, make_client, args.clients, args.requests,
+                                        memberships, get_offsets(), args.seed)
+        if name == MIXED:
+            samples = [(f'{MIXED} {operation}', status, latency) for operation, status, latency in samples]
+        results.update(summarize_samples(samples, seconds))
+    return results
+
+
+### Output ###
+def print_results(results, previous=None):
+    columns = ('count', 'errors', 'throughput', 'mean_ms', 'p50_ms', 'p99_ms', 'max_ms')
+    print(f'{"":>12}' + ''.join(f'{column:>12}' for column in columns))
+    for operation, result in results.items():
+        print(f'{operation:>12}' + ''.join(f'{format_value(result[column]):>12}' for column in columns))
+        if previous and operation in previous:
+            changes = [change(previous[operation].get(column), result[column]) for column in columns]
+            print(f'{"vs before":>12}' + ''.join(f'{value:>12}' for value in changes))
+
+def format_value(value):
+    if value is None:
+        return '-'
+    return f'{value:.2f}' if isinstance(value, float) else str(value)
+
+def change(before, after):
+    if not before or after is None:
+        return ''
+    return f'{100 * (after - before) / before:+.1f}%'
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('client', 'http'), default='client')
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask', help='Server to start in http mode')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--members', type=int, default=20, help='Users that have joined every room')
+    parser.add_argument('--messages', type=int, default=20000, help='Messages seeded (spread over the rooms)')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=2000, help='Iterations of every workload')
+    parser.add_argument('--workloads', nargs='+', choices=[*WORKLOADS, MIXED], default=[*WORKLOADS, MIXED])
+    parser.add_argument('--startup-runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='Where the DB is created (reused if it already exists), a temporary dir by default')
+    parser.add_argument('--output', help='Save the results as JSON in this file')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+    # The client mode changes the working directory
+    args.output = args.output and os.path.abspath(args.output)
+    args.compare = args.compare and os.path.abspath(args.compare)
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='zero-chat-bench-'))
+    path = os.path.join(workdir, chat_db.DB_PATH)
+    if os.path.exists(path):
+        print(f'Reusing the DB in {path}')
+        memberships = load_memberships(path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        start = time.perf_counter()
+        memberships = seed(path, args.users, args.rooms, args.members, args.messages, args.seed)
+        print(f'Seeded {path} in {time.perf_counter() - start:.1f}s')
+    memberships = {room: users for room, users in memberships.items() if users}
+
+    if args.mode == 'client':
+        results = run_client_mode(args, workdir, memberships)
+    else:
+        results = run_http_mode(args, workdir, memberships)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    print_results(results, previous)
+
+    if args.output:
+        report = {'created': datetime.now().isoformat(timespec='seconds'),
+                  'commit': git_commit(),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'config': {key: value for key, value in vars(args).items()
+                             if key not in ('output', 'compare', 'workdir')},
+                  'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results saved in {args.output}')
+
+
+if __name__ == '__main__':
+    main()
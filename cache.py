@@ -0,0 +1,338 @@
+'''
+Bounded in-memory cache for the messages of the rooms
+
+Only the most recent messages of every room are kept in memory (up to a fixed
+capacity per room) and the whole cache has a global budget of bytes: when it is
+exceeded the least recently used rooms are dropped completely.
+
+Anything that is not in memory is read from the DB, so the cache is transparent
+for the server: it always answers with the messages newer than an offset
+
+The messages are not kept as Message tuples (with a datetime and two strings each, several
+hundred bytes per message) but by columns in compact arrays, see RoomCache. The content is
+kept already escaped as JSON so the encoded messages sent to the clients are just formatted,
+either one object per message or by columns (see formats.py)
+'''
+import json
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime
+
+from db import Message
+from responses import dumps
+
+DEFAULT_ROOM_CAPACITY = 1000             # Max messages kept in memory per room
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024     # Max bytes used by all the cached messages
+ROW_BYTES = 8 + 8 + 4 + 8                # Bytes per message in the arrays of a RoomCache (offset, timestamp, user, end)
+
+# What MessageCache reads return: Message tuples, encoded JSON objects or encoded JSON columns
+MESSAGES = 'messages'
+ENCODED = 'encoded'
+COLUMNS = 'columns'
+
+# Same as server.message_to_json, %s are JSON encoded strings
+MESSAGE_JSON = b'{"offset":%d,"username":%s,"content":%s,"timestamp":%d}'
+# The fields of the columns format, %s are the comma separated JSON values of every column
+COLUMNS_JSON = b'"offsets":[%s],"usernames":[%s],"contents":[%s],"timestamps":[%s]'
+
+
+def timestamp_to_int(timestamp):
+    ''' The datetime as microseconds since the epoch '''
+    return int(datetime.timestamp(timestamp)) * 1000000 + timestamp.microsecond
+
+def int_to_timestamp(value):
+    seconds, microseconds = divmod(value, 1000000)
+    return datetime.fromtimestamp(seconds).replace(microsecond=microseconds)
+
+def encode_message(message):
+    ''' The encoded JSON of a message sent to the clients '''
+    return MESSAGE_JSON % (message.offset, dumps(message.username), dumps(message.content),
+                           int(datetime.timestamp(message.timestamp)))
+
+def encode_columns(messages):
+    ''' The encoded JSON columns of some messages (see COLUMNS_JSON) '''
+    return COLUMNS_JSON % (b','.join(b'%d' % message.offset for message in messages),
+                           b','.join(dumps(message.username) for message in messages),
+                           b','.join(dumps(message.content) for message in messages),
+                           b','.join(b'%d' % int(datetime.timestamp(message.timestamp)) for message in messages))
+
+
+class UsernameTable:
+    ''' Interns the usernames so every message only keeps a small id '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ids = {}      # A dict with usernames as keys and their id as values
+        self.names = []    # The usernames by id
+        self.encoded = []  # The JSON encoded usernames by id
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, username):
+        ''' The id of the username '''
+        user_id = self.ids.get(username)
+        if user_id is None:
+            with self._lock:
+                user_id = self.ids.get(username)
+                if user_id is None:
+                    user_id = len(self.names)
+                    self.names.append(username)
+                    self.encoded.append(dumps(username))
+                    self.ids[username] = user_id  # Last, so a reader that finds the id finds the name
+        return user_id
+
+
+class RoomCache:
+    ''' The cached tail of the messages of a room, stored by columns
+
+    Row i has its offset, timestamp (as microseconds, see timestamp_to_int) and user id
+    at position i of the arrays, and its JSON escaped content is content[ends[i - 1]:ends[i]].
+    When the room is over capacity the oldest rows are not removed one by one, they are
+    just skipped (`_start`) and the arrays are compacted once there are `capacity` dead rows '''
+    def __init__(self, roomname, usernames, capacity, complete):
+        self.roomname = roomname
+        self.usernames = usernames  # The UsernameTable shared by all the rooms
+        self.capacity = capacity
+        self.complete = complete    # True if this holds every message of the room
+        self.offsets = array('q')
+        self.timestamps = array('q')
+        self.users = array('l')
+        self.ends = array('q')
+        self.content = bytearray()
+        self._start = 0             # Position of the oldest live row
+
+    def __len__(self):
+        return len(self.offsets) - self._start
+
+    @property
+    def nbytes(self):
+        return len(self.offsets) * ROW_BYTES + len(self.content)
+
+    @property
+    def last_offset(self):
+        return self.offsets[-1] if len(self) else None
+
+    @property
+    def first_offset(self):
+        return self.offsets[self._start] if len(self) else None
+
+    def append(self, message):
+        ''' Appends a message newer than every cached one '''
+        self._append_row(message.offset, timestamp_to_int(message.timestamp),
+                         self.usernames.intern(message.username), dumps(message.content))
+
+    def copy_from(self, other, start):
+        ''' Appends the messages of another RoomCache from position `start` on '''
+        for i in range(other._start + start, len(other.offsets)):
+            self._append_row(other.offsets[i], other.timestamps[i], other.users[i], other._content(i))
+
+    def first_index_after(self, offset):
+        ''' Position of the first cached message with an offset higher than `offset` '''
+        return bisect_right(self.offsets, offset, self._start) - self._start
+
+    def messages(self, start, stop):
+        ''' The messages in positions [start, stop) as Message tuples '''
+        names = self.usernames.names
+        return [Message(offset=self.offsets[i], roomname=self.roomname, username=names[self.users[i]],
+                        content=json.loads(self._content(i)), timestamp=int_to_timestamp(self.timestamps[i]))
+                for i in self._range(start, stop)]
+
+    def encode(self, start, stop):
+        ''' The messages in positions [start, stop) encoded as the items of a JSON array '''
+        encoded_names = self.usernames.encoded
+        offsets, timestamps, users = self.offsets, self.timestamps, self.users
+        return b','.join(MESSAGE_JSON % (offsets[i], encoded_names[users[i]], self._content(i), timestamps[i] // 1000000)
+                         for i in self._range(start, stop))
+
+    def encode_columns(self, start, stop):
+        ''' The messages in positions [start, stop) encoded by columns (see COLUMNS_JSON) '''
+        rows = self._range(start, stop)
+        encoded_names = self.usernames.encoded
+        users = self.users
+        return COLUMNS_JSON % (b','.join(b'%d' % offset for offset in self.offsets[rows.start:rows.stop]),
+                               b','.join([encoded_names[users[i]] for i in rows]),
+                               b','.join([self._content(i) for i in rows]),
+                               b','.join(b'%d' % (timestamp // 1000000)
+                                         for timestamp in self.timestamps[rows.start:rows.stop]))
+
+    def _range(self, start, stop):
+        return range(self._start + start, self._start + min(stop, len(self)))
+
+    def _content(self, i):
+        return self.content[self.ends[i - 1] if i else 0:self.ends[i]]
+
+    def _append_row(self, offset, timestamp, user, content):
+        self.content += content
+        self.offsets.append(offset)
+        self.timestamps.append(timestamp)
+        self.users.append(user)
+        self.ends.append(len(self.content))
+        if len(self) > self.capacity:
+            self._start += 1
+            self.complete = False
+            if self._start >= self.capacity:
+                self._compact()
+
+    def _compact(self):
+        ''' Removes the dead rows '''
+        start, base = self._start, self.ends[self._start - 1]
+        del self.offsets[:start]
+        del self.timestamps[:start]
+        del self.users[:start]
+        self.ends = array('q', [end - base for end in self.ends[start:]])
+        del self.content[:base]
+        self._start = 0
+
+
+class MessageCache:
+    ''' Keeps the most recent messages of the most recently used rooms '''
+    def __init__(self, db, room_capacity=DEFAULT_ROOM_CAPACITY, max_bytes=DEFAULT_MAX_BYTES):
+        self.db = db
+        self.room_capacity = room_capacity
+        self.max_bytes = max_bytes
+        self.usernames = UsernameTable()
+        self._lock = threading.RLock()
+        self._rooms = OrderedDict()  # A dict with rooms as keys and their RoomCache, least recently used first
+        self.nbytes = 0
+        self.hits = 0       # Reads answered from memory
+        self.misses = 0     # Reads that had to go to the DB
+        self.evictions = 0  # Rooms dropped to stay under max_bytes
+
+    def __contains__(self, room):
+        with self._lock:
+            return room in self._rooms
+
+    def load(self, room, messages, complete):
+        ''' Stores the tail of the room (oldest first), `complete` if it is the whole room history '''
+        room_cache = RoomCache(room, self.usernames, self.room_capacity, complete)
+        for message in messages:
+            room_cache.append(message)
+        with self._lock:
+            old = self._rooms.pop(room, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+                # Keep the messages appended while we were reading from the DB
+                last = room_cache.last_offset
+                room_cache.copy_from(old, old.first_index_after(-1 if last is None else last))
+            self._rooms[room] = room_cache
+            self.nbytes += room_cache.nbytes
+            self._evict(keep=room)
+
+    def forget(self, room):
+        ''' Drops the room from the cache '''
+        with self._lock:
+            room_cache = self._rooms.pop(room, None)
+            if room_cache is not None:
+                self.nbytes -= room_cache.nbytes
+
+    def append(self, message):
+        ''' Adds a new message (already stored in the DB) to its room '''
+        with self._lock:
+            room_cache = self._rooms.get(message.roomname)
+            if room_cache is None:
+                # Only the new messages are known, the rest is loaded from the DB when needed
+                room_cache = self._rooms[message.roomname] = RoomCache(message.roomname, self.usernames,
+                                                                       self.room_capacity, False)
+            elif len(room_cache) and room_cache.last_offset >= message.offset:
+                return  # Already cached (it was loaded from the DB before it got here)
+            self._rooms.move_to_end(message.roomname)
+            before = room_cache.nbytes
+            room_cache.append(message)
+            self.nbytes += room_cache.nbytes - before
+            self._evict(keep=message.roomname)
+
+    def get(self, room, since=-1, limit=None):
+        ''' Returns the messages of the room with an offset higher than `since`, oldest first '''
+        return self._get(room, since, limit, form=MESSAGES)
+
+    def get_encoded(self, room, since=-1, limit=None):
+        ''' Same as `get` but returns the messages encoded as the items of a JSON array (see encode_message) '''
+        return self._get(room, since, limit, form=ENCODED)
+
+    def get_columns(self, room, since=-1, limit=None):
+        ''' Same as `get` but returns the messages encoded by columns (see encode_columns) '''
+        return self._get(room, since, limit, form=COLUMNS)
+
+    def get_encoded_many(self, rooms, limit=None, columns=False):
+        ''' `get_encoded` (or `get_columns`) for many rooms at once, `rooms` is a dict with rooms as
+        keys and their `since` as values
+
+        Returns a dict with the same keys. The cached rooms are all read in a single pass under the lock '''
+        form = COLUMNS if columns else ENCODED
+        with self._lock:
+            found = {room: self._lookup(room, since, limit, form) for room, since in rooms.items()}
+            missing = [room for room, messages in found.items() if messages is None]
+            self.hits += len(found) - len(missing)
+        for room in missing:
+            found[room] = self._get(room, rooms[room], limit, form)
+        return found
+
+    def _get(self, room, since, limit, form):
+        with self._lock:
+            messages = self._lookup(room, since, limit, form)
+            if messages is not None:
+                self.hits += 1
+                return messages
+            self.misses += 1
+            room_cache = self._rooms.get(room)
+            partial = room_cache is None or len(room_cache) < self.room_capacity
+        if partial:
+            # The room is cold (or only has its newest messages): bring its tail into memory
+            self.load_tail(room)
+            with self._lock:
+                messages = self._lookup(room, since, limit, form)
+            if messages is not None:
+                return messages
+        messages = self.db.get_room_messages_since(room, since, limit)
+        if form == ENCODED:
+            return b','.join(encode_message(message) for message in messages)
+        if form == COLUMNS:
+            return encode_columns(messages)
+        return messages
+
+    def load_tail(self, room):
+        ''' Loads the most recent messages of the room from the DB '''
+        messages = self.db.get_room_tail(room, self.room_capacity)
+        # The tail does not include the archived messages, if there are any the first offset is not 0
+        complete = len(messages) < self.room_capacity and (not messages or messages[0].offset == 0)
+        self.load(room, messages, complete=complete)
+
+    def stats(self):
+        with self._lock:
+            return {'rooms': len(self._rooms),
+                    'messages': sum(len(room_cache) for room_cache in self._rooms.values()),
+                    'usernames': len(self.usernames),
+                    'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes,
+                    'room_capacity': self.room_capacity,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _lookup(self, room, since, limit, form=MESSAGES):
+        ''' The cached messages newer than `since`, None if the cache cannot answer '''
+        room_cache = self._rooms.get(room)
+        if room_cache is None:
+            return None
+        if not room_cache.complete and not (len(room_cache) and room_cache.first_offset <= since + 1):
+            return None
+        self._rooms.move_to_end(room)
+        start = room_cache.first_index_after(since)
+        stop = len(room_cache) if limit is None else start + limit
+        if form == ENCODED:
+            return room_cache.encode(start, stop)
+        if form == COLUMNS:
+            return room_cache.encode_columns(start, stop)
+        return room_cache.messages(start, stop)
+
+    def _evict(self, keep):
+        ''' Drops the least recently used rooms (but `keep`) until we are under budget '''
+        while self.nbytes > self.max_bytes and len(self._rooms) > 1:
+            room = next(iter(self._rooms))
+            if room == keep:
+                break
+            room_cache = self._rooms.pop(room)
+            self.nbytes -= room_cache.nbytes
+            self.evictions += 1
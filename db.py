@@ -21,24 +21,519 @@ TABLE joined_rooms:
 This table shows which rooms has a user joined
 
 TABLE messages:
- offset (INTEGER) | room (TEXT) | username (TEXT) | message (TEXT) | timestamp (DATETIME)
+ id (INTEGER) PK | offset (INTEGER) | room (TEXT) | username (TEXT) | message (TEXT) | timestamp (DATETIME)
 This table stores every message in a room, with its corresponding offset, username, room and timestamp
+(offset, room) is unique, `id` is the rowid (explicit, so VACUUM never changes it)
+
+Connections come from a ConnectionPool: readers check out one of a bounded set of
+connections while every write goes through a single serialized writer connection,
+which is the concurrency model SQLite has in WAL mode (many readers, one writer).
+
+Messages are not committed one by one: they are handed to a MessageWriter thread
+that stores them in batches (group commit), so many messages share a single fsync
+
+TABLE schema_version:
+ version (INTEGER)
+The last migration of MIGRATIONS applied to this DB, so old DBs are upgraded in place
+
+TABLE messages_fts:
+ content (FTS5 external content table of messages, by rowid, that is messages.id)
+The full text index of the messages, kept in sync with triggers. The messages that already
+existed when it was created are indexed in chunks by a background thread (see SearchBackfill),
+the rows still pending are in TABLE search_backfill: next_rowid (INTEGER) | last_rowid (INTEGER)
+
+TABLE retention_policies:
+ roomname (TEXT) PK | max_age (REAL) | max_count (INTEGER)
+How long (seconds) and how many messages of a room are kept in the messages table, NULL is no limit
+
+TABLE archive_segments:
+ roomname (TEXT) | first_offset (INTEGER) both PK | last_offset (INTEGER) | count (INTEGER) | path (TEXT) | created (REAL)
+The messages moved out of the messages table by the retention policies, every segment is a
+compressed file with a range of offsets of a room (see archive.py)
+
+TABLE events:
+ id (INTEGER) PK | created (REAL) | origin (TEXT) | kind (TEXT) | roomname (TEXT) | username (TEXT) | offset (INTEGER)
+A feed of the changes made by every server process, only used when several processes
+share the DB (see backend.py)
 '''
 import sqlite3 as sqlite
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
 from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
 
+import metrics
+from archive import Archive, ARCHIVE_SEGMENT_SIZE
+
+log = logging.getLogger(__name__)
+
 # named tuple as message?
 # Fields: (offset room PK) user content timestamp
 Message = namedtuple('Message', ['offset', 'roomname', 'username', 'content', 'timestamp'])
+# A row of the events table, `message` is only set for the 'message' events
+Event = namedtuple('Event', ['id', 'origin', 'kind', 'roomname', 'username', 'message'])
+
+DB_PATH = 'db/testdb.db'
+POOL_SIZE = 8                  # Max reader connections open at the same time
+GROUP_COMMIT_INTERVAL = 0.005  # Max seconds a message waits for more messages to join its batch
+GROUP_COMMIT_SIZE = 256        # Max messages written in a single transaction
+SEARCH_BACKFILL_CHUNK = 5000   # Messages indexed per transaction by SearchBackfill
+SEARCH_BACKFILL_PAUSE = 0.05   # Seconds between two chunks, so the message writer is not starved
+
+# PRAGMAs applied to every connection (in this order, page_size only has effect on new DBs)
+PERFORMANCE_PROFILE = {
+    'page_size': 4096,
+    'journal_mode': 'WAL',         # Readers do not block the writer and the other way around
+    'synchronous': 'NORMAL',       # With WAL this is still safe against corruption, only fsyncs on checkpoints
+    'cache_size': -64 * 1024,      # Negative means KiB, so 64 MiB of page cache per connection
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,          # Milliseconds to wait on a locked DB instead of failing
+}
+
+# The triggers keeping messages_fts in sync with messages, they leave alone the rows waiting for the backfill
+# (SearchBackfill indexes their current content)
+MESSAGES_FTS_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+       WHEN NOT EXISTS (SELECT 1 FROM search_backfill WHERE new.rowid BETWEEN next_rowid AND last_rowid)
+       BEGIN
+           INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+       WHEN NOT EXISTS (SELECT 1 FROM search_backfill WHERE old.rowid BETWEEN next_rowid AND last_rowid)
+       BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages
+       WHEN NOT EXISTS (SELECT 1 FROM search_backfill WHERE old.rowid BETWEEN next_rowid AND last_rowid)
+       BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+           INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+       END''']
+
+# Schema changes applied on top of the tables created in DB.__init__, in order
+# Each entry is (version, statements). Never modify an entry, add a new one instead
+MIGRATIONS = [
+    (1, ['''CREATE INDEX IF NOT EXISTS messages_roomname_offset
+            ON messages (roomname, offset)''',
+         '''CREATE INDEX IF NOT EXISTS joined_rooms_roomname_username
+            ON joined_rooms (roomname, username)''']),
+    (2, ['''CREATE TABLE IF NOT EXISTS events
+            (id INTEGER PRIMARY KEY AUTOINCREMENT,
+             created REAL,
+             origin TEXT,
+             kind TEXT,
+             roomname TEXT,
+             username TEXT,
+             offset INTEGER)''']),
+    (3, ['''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(content, content='messages', content_rowid='rowid',
+                       tokenize='unicode61 remove_diacritics 2')''',
+         # The rowids of the messages that existed before the index, indexed by SearchBackfill
+         '''CREATE TABLE IF NOT EXISTS search_backfill
+            (next_rowid INTEGER,
+             last_rowid INTEGER)''',
+         '''INSERT INTO search_backfill (next_rowid, last_rowid)
+            SELECT MIN(rowid), MAX(rowid) FROM messages HAVING COUNT(*) > 0''',
+         *MESSAGES_FTS_TRIGGERS]),
+    (4, ['''CREATE TABLE IF NOT EXISTS retention_policies
+            (roomname TEXT PRIMARY KEY,
+             max_age REAL,
+             max_count INTEGER)''',
+         '''CREATE TABLE IF NOT EXISTS archive_segments
+            (roomname TEXT,
+             first_offset INTEGER,
+             last_offset INTEGER,
+             count INTEGER,
+             path TEXT,
+             created REAL,
+             PRIMARY KEY (roomname, first_offset))''']),
+    # An explicit INTEGER PRIMARY KEY, so VACUUM can never renumber the rowids messages_fts is keyed on.
+    # The table is rebuilt keeping every rowid as its id, so the index and search_backfill stay valid
+    (5, ['DROP TRIGGER IF EXISTS messages_fts_insert',
+         'DROP TRIGGER IF EXISTS messages_fts_delete',
+         'DROP TRIGGER IF EXISTS messages_fts_update',
+         '''CREATE TABLE messages_v5
+            (id INTEGER PRIMARY KEY,
+             offset INTEGER,
+             roomname TEXT,
+             username TEXT,
+             content  TEXT,
+             timestamp TIMESTAMP,
+             UNIQUE (offset, roomname),
+             FOREIGN KEY (username) REFERENCES users(name),
+             FOREIGN KEY (roomname) REFERENCES rooms(name))''',
+         '''INSERT INTO messages_v5 (id, offset, roomname, username, content, timestamp)
+            SELECT rowid, offset, roomname, username, content, timestamp FROM messages''',
+         'DROP TABLE messages',
+         'ALTER TABLE messages_v5 RENAME TO messages',
+         '''CREATE INDEX IF NOT EXISTS messages_roomname_offset
+            ON messages (roomname, offset)''',
+         *MESSAGES_FTS_TRIGGERS]),
+]
+
+INSERT_MESSAGE = '''INSERT INTO messages (offset, roomname, username, content, timestamp)
+                    VALUES (?, ?, ?, ?, ?)'''
+INSERT_EVENT = '''INSERT INTO events (created, origin, kind, roomname, username, offset)
+                  VALUES (?, ?, ?, ?, ?, ?)'''
+
+### Metrics ###
+METHOD_SECONDS = metrics.REGISTRY.histogram('zero_chat_db_method_seconds',
+                                            'Seconds spent in every method of DB', ['method'])
+WRITE_SECONDS = metrics.REGISTRY.histogram('zero_chat_db_write_seconds',
+                                           'Seconds spent writing a batch of messages (with its commit)')
+WRITE_BATCH_SIZE = metrics.REGISTRY.histogram('zero_chat_db_write_batch_size', 'Messages per written batch',
+                                              buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+MESSAGES_ARCHIVED = metrics.REGISTRY.counter('zero_chat_db_messages_archived_total',
+                                             'Messages moved from the messages table to the archive')
+MESSAGES_WRITTEN = metrics.REGISTRY.counter('zero_chat_db_messages_written_total',
+                                            'Messages handed to the writer, by result', ['result'])
+
+
+def connect(path, profile=PERFORMANCE_PROFILE, check_same_thread=True):
+    ''' Opens a connection to the DB with the performance profile applied '''
+    con = sqlite.connect(path,
+            detect_types=sqlite.PARSE_DECLTYPES, # To use TIMESTAMP as type later (has to be a datetime.datetime object
+            check_same_thread=check_same_thread)
+    for pragma, value in profile.items():
+        con.execute(f'PRAGMA {pragma} = {value}')
+    return con
+
+
+def migrate(con):
+    ''' Applies the MIGRATIONS this DB does not have yet, returns the schema version '''
+    con.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                   (version INTEGER NOT NULL)''')
+    row = con.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    current = row[0] if row[0] is not None else 0
+    for version, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        log.info('Migrating DB schema to version %s', version)
+        with con:  # Every migration is applied atomically
+            con.execute('BEGIN')  # Explicit, sqlite3 would only open the transaction before the first DML statement
+            for statement in statements:
+                con.execute(statement)
+            con.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+        current = version
+    return current
+
+
+class ConnectionPool:
+    ''' A bounded pool of reader connections and a single writer connection shared by every thread '''
+    def __init__(self, path, profile=PERFORMANCE_PROFILE, size=POOL_SIZE):
+        self.path = path
+        self.profile = profile
+        self.size = size
+        self._idle = queue.LifoQueue()  # Reader connections not in use, the most recent first (warm cache)
+        self._lock = threading.Lock()
+        self._readers = []              # Every reader connection opened
+        self._writer = connect(path, profile, check_same_thread=False)
+        self._writer_lock = threading.Lock()
+        # Metrics
+        self.reader_waits = 0           # Checkouts that had to wait for a free reader
+        self.reader_wait_time = 0.0     # Total seconds spent waiting for readers
+        self.writer_waits = 0           # Writes that had to wait for the writer
+        self.writer_wait_time = 0.0     # Total seconds spent waiting for the writer
+
+    @contextmanager
+    def reader(self):
+        ''' Checks out a reader connection for the duration of the with block '''
+        con = self._checkout()
+        try:
+            yield con
+        finally:
+            self._idle.put(con)
+
+    @contextmanager
+    def writer(self):
+        ''' Holds the writer connection (and the write lock) for the duration of the with block '''
+        if not self._writer_lock.acquire(blocking=False):
+            start = time.monotonic()
+            self._writer_lock.acquire()
+            self.writer_waits += 1
+            self.writer_wait_time += time.monotonic() - start
+        try:
+            yield self._writer
+        finally:
+            if self._writer.in_transaction:
+                # Whoever used it swallowed an error, do not leave the DB locked
+                self._writer.rollback()
+            self._writer_lock.release()
+
+    def stats(self):
+        return {'size': self.size,
+                'readers_open': len(self._readers),
+                'readers_idle': self._idle.qsize(),
+                'reader_waits': self.reader_waits,
+                'reader_wait_time': self.reader_wait_time,
+                'writer_waits': self.writer_waits,
+                'writer_wait_time': self.writer_wait_time}
+
+    def close(self):
+        with self._writer_lock:
+            self._writer.close()
+        with self._lock:
+            for con in self._readers:
+                con.close()
+            self._readers = []
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._readers) < self.size:
+                con = connect(self.path, self.profile, check_same_thread=False)
+                self._readers.append(con)
+                return con
+        start = time.monotonic()
+        con = self._idle.get()
+        self.reader_waits += 1
+        self.reader_wait_time += time.monotonic() - start
+        return con
+
+
+class PendingWrite:
+    ''' A message waiting in the MessageWriter queue '''
+    def __init__(self, message, on_stored=None):
+        self.message = message
+        self.on_stored = on_stored  # Called with the message by the writer thread once it is committed
+        self.ok = None  # True once it is stored, False if it failed
+        self.future = concurrent.futures.Future()  # Resolves to `ok`, can be awaited with asyncio.wrap_future
+        self.future.set_running_or_notify_cancel()  # So whoever waits for it cannot cancel it under the writer
+
+    def done(self, ok):
+        self.ok = ok
+        if ok and self.on_stored is not None:
+            try:
+                self.on_stored(self.message)
+            except Exception as e:
+                log.error('Error running the on_stored callback of message %s: %s', self.message, e)
+        self.future.set_result(ok)
 
+    def wait(self, timeout=None):
+        ''' Blocks until the message is durable, returns whether it was stored '''
+        try:
+            return self.future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+
+
+class MessageWriter:
+    ''' Stores the messages from a dedicated thread, many of them per transaction
+
+    The thread takes the first pending message, waits up to `interval` seconds for more
+    (or until it has `batch_size`) and writes all of them with a single executemany and commit.
+    If the batch fails the messages are retried one by one so only the bad ones fail
+    (messages submitted together with `submit_many` are retried, and fail, together).
+    Messages are written (and their PendingWrite completed) in the order they were submitted.
+
+    When `origin` is set (several processes share the DB, see backend.py) the messages are
+    submitted without an offset: it is handed out inside the write transaction, which holds
+    the DB write lock, and every message is also logged in the events table '''
+    def __init__(self, pool, interval=GROUP_COMMIT_INTERVAL, batch_size=GROUP_COMMIT_SIZE):
+        self.pool = pool
+        self.interval = interval
+        self.batch_size = batch_size
+        self.origin = None  # Name of this process in the events table, None if the DB is not shared
+        self._queue = queue.Queue()
+        self._pending = 0  # Messages submitted and not written yet
+        self._pending_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, message, on_stored=None):
+        ''' Enqueues the message, returns a PendingWrite to wait for it '''
+        return self.submit_many([message], on_stored)[0]
+
+    def submit_many(self, messages, on_stored=None):
+        ''' Enqueues the messages to be written in the same transaction, all or none of them
+
+        Returns a PendingWrite per message '''
+        group = [PendingWrite(message, on_stored) for message in messages]
+        with self._pending_lock:
+            self._pending += len(group)
+        self._queue.put(group)
+        return group
+
+    def backlog(self):
+        ''' Number of messages waiting to be written '''
+        return self._pending
+
+    def stop(self):
+        ''' Writes whatever is pending and stops the thread '''
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            first = self._queue.get()
+            if first is None:
+                break
+            groups = [first]
+            size = len(first)
+            deadline = time.monotonic() + self.interval
+            while size < self.batch_size:
+                try:
+                    group = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if group is None:
+                    running = False
+                    break
+                groups.append(group)
+                size += len(group)
+            with self.pool.writer() as con, WRITE_SECONDS.time():
+                results = self._write(con, groups)
+            # Completed once the write lock is released: on_stored callbacks take other locks (the room
+            # locks of server.py) whose holders may be waiting for the write lock
+            for group, ok in results:
+                for pending in group:
+                    pending.done(ok)
+            with self._pending_lock:
+                self._pending -= size
+            WRITE_BATCH_SIZE.observe(size)
+
+    def _write(self, con, groups):
+        ''' Writes the groups of messages (lists of PendingWrite), returns (group, ok) pairs '''
+        # Any error (not only the ones of SQLite, e.g. a string SQLite cannot encode) fails the messages
+        # involved and nothing else: this thread must keep running or no message is ever written again
+        try:
+            self._store(con, [pending for group in groups for pending in group])
+        except Exception:
+            results = []
+            for group in groups:
+                try:
+                    self._store(con, group)
+                except Exception as e:
+                    for pending in group:
+                        log.error('Error sending message %s in room %s: %s', pending.message, pending.message.roomname, e)
+                    MESSAGES_WRITTEN.inc(len(group), result='error')
+                    results.append((group, False))
+                else:
+                    MESSAGES_WRITTEN.inc(len(group), result='ok')
+                    results.append((group, True))
+            return results
+        else:
+            for group in groups:
+                MESSAGES_WRITTEN.inc(len(group), result='ok')
+            return [(group, True) for group in groups]
+
+    def _store(self, con, batch):
+        ''' Writes the messages in a single transaction '''
+        with con:
+            if self.origin is not None:
+                con.execute('BEGIN IMMEDIATE')  # Take the write lock before reading the last offsets
+                self._allocate_offsets(con, batch)
+            con.executemany(INSERT_MESSAGE, [tuple(pending.message) for pending in batch])
+            if self.origin is not None:
+                now = time.time()
+                con.executemany(INSERT_EVENT, [(now, self.origin, 'message', pending.message.roomname,
+                                                pending.message.username, pending.message.offset)
+                                               for pending in batch])
+
+    def _allocate_offsets(self, con, batch):
+        next_offsets = {}
+        for pending in batch:
+            room = pending.message.roomname
+            if room not in next_offsets:
+                cur = con.execute('''SELECT COALESCE(MAX(offset), -1) + 1
+                                     FROM messages
+                                     WHERE roomname = ?''', (room,))
+                next_offsets[room] = cur.fetchone()[0]
+            pending.message = pending.message._replace(offset=next_offsets[room])
+            next_offsets[room] += 1
+
+
+class SearchBackfill:
+    ''' Indexes the messages that existed before messages_fts was created
+
+    A chunk of rowids per transaction from a background thread, pausing between chunks so
+    the message writer gets the write lock in between. The messages sent meanwhile are
+    indexed by the triggers, so searches work (on part of the history) while this runs '''
+    def __init__(self, pool, chunk=SEARCH_BACKFILL_CHUNK, pause=SEARCH_BACKFILL_PAUSE):
+        self.pool = pool
+        self.chunk = chunk
+        self.pause = pause
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='search-backfill', daemon=True)
+        if self.remaining():
+            self._thread.start()
+
+    def remaining(self):
+        ''' Upper bound of the messages still waiting to be indexed '''
+        with self.pool.reader() as con:
+            row = con.execute('SELECT last_rowid - next_rowid + 1 FROM search_backfill').fetchone()
+            return row[0] if row is not None else 0
+
+    def index_chunk(self):
+        ''' Indexes the next chunk, returns whether there is anything left '''
+        with self.pool.writer() as con:
+            with con:
+                row = con.execute('SELECT next_rowid, last_rowid FROM search_backfill').fetchone()
+                if row is None:
+                    return False
+                next_rowid, last_rowid = row
+                end = min(next_rowid + self.chunk - 1, last_rowid)
+                con.execute('''INSERT INTO messages_fts (rowid, content)
+                               SELECT rowid, content
+                               FROM messages
+                               WHERE rowid BETWEEN ? AND ?''', (next_rowid, end))
+                if end >= last_rowid:
+                    con.execute('DELETE FROM search_backfill')
+                    return False
+                con.execute('UPDATE search_backfill SET next_rowid = ?', (end + 1,))
+                return True
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set() and self.index_chunk():
+                self._stopped.wait(self.pause)
+        except sqlite.Error as e:
+            log.error('Error indexing the messages for search: %s', e)
+
+
+def search_query(text):
+    ''' Turns the text of a search into an FTS5 query: every word must be in the message
+    (a word ending in * matches any word starting with it) '''
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            # Quoted so the FTS5 syntax (AND, OR, NEAR, column:...) is never interpreted
+            terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+
+@metrics.instrument_methods(METHOD_SECONDS)
 class DB:
-    def __init__(self):
-        self.con = sqlite.connect('db/testdb.db',
-                detect_types=sqlite.PARSE_DECLTYPES, # To use TIMESTAMP as type later (has to be a datetime.datetime object
-                check_same_thread=False)             # Share connection between Threads
+    def __init__(self, path=DB_PATH, profile=PERFORMANCE_PROFILE):
+        self.path = path
+        self.pool = ConnectionPool(path, profile)
+        with self.pool.writer() as con:
+            self._create_tables(con)
+            self.schema_version = migrate(con)
+        self.message_writer = MessageWriter(self.pool)
+        self.search_backfill = SearchBackfill(self.pool)
+        self.archive = Archive(os.path.join(os.path.dirname(path), 'archive'))
+
+    def _create_tables(self, con):
         # Create test table
-        cur = self.con.cursor()
+        cur = con.cursor()
         # TODO: create REAL persistence
         cur.execute('''CREATE TABLE IF NOT EXISTS users
                        (name text PRIMARY KEY)''')
@@ -74,167 +569,482 @@ class DB:
                         PRIMARY KEY (offset, roomname),
                         FOREIGN KEY (username) REFERENCES users(name),
                         FOREIGN KEY (roomname) REFERENCES rooms(name))''')
-        self.con.commit()
+        con.commit()
 
     def test(self):
-        cur = self.con.cursor()
-        cur.execute('SELECT SQLITE_VERSION()')
-        data = cur.fetchone()[0]
-        print('SQLite version:', data)
-
-    def get_joined_rooms(self, user):
-        ''' Returns all the rooms the user has joined'''
-        cur = self.con.cursor()
-        cur.execute('''SELECT roomname
-                       FROM joined_rooms
-                       WHERE username = ?
-                    ''', user)
-        rooms = [room for room, _ in cur.fetchall()]
-        return rooms
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('SELECT SQLITE_VERSION()')
+            data = cur.fetchone()[0]
+            log.info('SQLite version: %s', data)
 
     ### Users ###
     def get_users(self):
         ''' Returns all the users from the DB'''
-        cur = self.con.cursor()
-        cur.execute('''SELECT * FROM users''')
-        # cur.fetchall returns a tuple of the same shape as the table shape
-        # in this case (name,)
-        users = [user for user, in cur.fetchall()]
-        return users
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('''SELECT * FROM users''')
+            # cur.fetchall returns a tuple of the same shape as the table shape
+            # in this case (name,)
+            users = [user for user, in cur.fetchall()]
+            return users
 
     def create_user(self, user):
         '''Create a new user'''
-        print(f'Create user received {user} as user')
-        cur = self.con.cursor()
-        try:
-            cur.execute('''INSERT INTO users (name)
-                       VALUES (?)''', (user,))
-            self.con.commit()
-        except sqlite.Error as e:
-            print(f'Error creating user {user}: {e}')
-            return False
-        return True
+        log.debug('Create user received %s as user', user)
+        with self.pool.writer() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('''INSERT INTO users (name)
+                           VALUES (?)''', (user,))
+                con.commit()
+            except sqlite.Error as e:
+                log.error('Error creating user %s: %s', user, e)
+                return False
+            return True
 
     def delete_user(self, user):
-        '''Delete a user from the database'''
-        cur = self.con.cursor()
-        try:
-            cur.execute('''DELETE FROM users WHERE name = ?''', (user,))
-            self.con.commit() # Not needed? No time to check
-        except sqlite.Error as e:
-            print(f'Error deleting user {user}: {e}')
-            return False
-        return True
+        '''Delete a user from the database, with all its joined rooms (in the same transaction)'''
+        with self.pool.writer() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('''DELETE FROM joined_rooms WHERE username = ?''', (user,))
+                cur.execute('''DELETE FROM users WHERE name = ?''', (user,))
+                con.commit()
+            except sqlite.Error as e:
+                con.rollback()
+                log.error('Error deleting user %s: %s', user, e)
+                return False
+            return True
 
 
     ### Rooms ###
     def get_rooms(self):
         ''' Returns all the available rooms'''
-        cur = self.con.cursor()
-        cur.execute('''SELECT * FROM rooms''')
-        rooms = [room for room, in cur.fetchall()]
-        return rooms
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('''SELECT * FROM rooms''')
+            rooms = [room for room, in cur.fetchall()]
+            return rooms
 
     def create_room(self, room):
         '''Create a new room'''
-        print(f'Create room received {room} as room')
-        cur = self.con.cursor()
-        try:
-            cur.execute('''INSERT INTO rooms (name)
-                       VALUES (?)''', (room,))
-            self.con.commit()
-        except sqlite.Error as e:
-            print(f'Error creating room {room}: {e}')
-            return False
-        return True
+        log.debug('Create room received %s as room', room)
+        with self.pool.writer() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('''INSERT INTO rooms (name)
+                           VALUES (?)''', (room,))
+                con.commit()
+            except sqlite.Error as e:
+                log.error('Error creating room %s: %s', room, e)
+                return False
+            return True
 
     def delete_room(self, room):
-        '''Delete a room from the database'''
-        cur = self.con.cursor()
-        try:
-            cur.execute('''DELETE FROM rooms WHERE name = ?''', (room,))
-            self.con.commit() # Not needed? No time to check
-        except sqlite.Error as e:
-            print(f'Error deleting room {room}: {e}')
+        '''Delete a room from the database, with its messages, memberships, retention policy and
+        archived segments (in the same transaction), so a room created later with the same name starts empty'''
+        with self.pool.writer() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('''SELECT path FROM archive_segments WHERE roomname = ?''', (room,))
+                paths = [path for path, in cur.fetchall()]
+                cur.execute('''DELETE FROM messages WHERE roomname = ?''', (room,))
+                cur.execute('''DELETE FROM joined_rooms WHERE roomname = ?''', (room,))
+                cur.execute('''DELETE FROM archive_segments WHERE roomname = ?''', (room,))
+                cur.execute('''DELETE FROM retention_policies WHERE roomname = ?''', (room,))
+                cur.execute('''DELETE FROM rooms WHERE name = ?''', (room,))
+                con.commit()
+            except sqlite.Error as e:
+                con.rollback()
+                log.error('Error deleting room %s: %s', room, e)
+                return False
+        # Not indexed anymore, the files can go once the transaction is committed
+        for path in paths:
+            self.archive.discard(path)
+        return True
 
     def get_joined_users(self, room):
         ''' gets all the users in the room '''
-        cur = self.con.cursor()
-        try:
-            cur.execute('''SELECT username AS name
-                           FROM joined_rooms
-                           WHERE roomname = ?''', (room,))
-            users = [user for user, in cur.fetchall()]
-            return users
-        except sqlite.Error as e:
-            print(f'Error fetching users for room: {room}: {e}')
-            return []
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('''SELECT username AS name
+                               FROM joined_rooms
+                               WHERE roomname = ?''', (room,))
+                users = [user for user, in cur.fetchall()]
+                return users
+            except sqlite.Error as e:
+                log.error('Error fetching users for room: %s: %s', room, e)
+                return []
+
+    def get_all_joined_users(self):
+        ''' gets all the (room, user) memberships of every room in a single query '''
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('''SELECT rooms.name, joined_rooms.username
+                               FROM rooms
+                               JOIN joined_rooms ON joined_rooms.roomname = rooms.name''')
+                return cur.fetchall()
+            except sqlite.Error as e:
+                log.error('Error fetching the users of all the rooms: %s', e)
+                return []
 
     ### Joined Rooms ###
     def get_joined_rooms(self, user):
         ''' gets all the rooms this user has joined '''
-        cur = self.con.cursor()
-        try:
-            cur.execute('''SELECT roomname AS name
-                           FROM joined_rooms
-                           WHERE username = ?''', (user,))
-            rooms = [room for room, in cur.fetchall()]
-            return rooms
-        except sqlite.Error as e:
-            print(f'Error fetching joined rooms from user {user}: {e}')
-            return []
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('''SELECT roomname AS name
+                               FROM joined_rooms
+                               WHERE username = ?''', (user,))
+                rooms = [room for room, in cur.fetchall()]
+                return rooms
+            except sqlite.Error as e:
+                log.error('Error fetching joined rooms from user %s: %s', user, e)
+                return []
 
     def join_room(self, user, room):
         '''Joins the user to the room'''
-        cur = self.con.cursor()
-        try:
-            cur.execute('''INSERT INTO joined_rooms (username, roomname)
-                       VALUES (?, ?)''', (user, room))
-            self.con.commit()
-        except sqlite.Error as e:
-            print(f'Error joining user {user} into room {room}: {e}')
-            return False
-        return True
+        with self.pool.writer() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('''INSERT INTO joined_rooms (username, roomname)
+                           VALUES (?, ?)''', (user, room))
+                con.commit()
+            except sqlite.Error as e:
+                log.error('Error joining user %s into room %s: %s', user, room, e)
+                return False
+            return True
 
     def leave_room(self, user, room):
         '''Removes the user from the room'''
-        cur = self.con.cursor()
-        try:
-            cur.execute('''DELETE FROM joined_rooms
-                           WHERE username = ? AND roomname = ?''', (user, room))
-            self.con.commit()
-        except sqlite.Error as e:
-            print(f'Error deleting user {user} from room {room}: {e}')
-            return False
-        return True
+        with self.pool.writer() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('''DELETE FROM joined_rooms
+                               WHERE username = ? AND roomname = ?''', (user, room))
+                con.commit()
+            except sqlite.Error as e:
+                log.error('Error deleting user %s from room %s: %s', user, room, e)
+                return False
+            return True
 
     ### Messages ### 
     def get_room_messages(self, room):
-        ''' Gets all the stored messages from this room '''
-        cur = self.con.cursor()
-        cur.execute('''SELECT *
-                       FROM messages
-                       WHERE roomname = ?''',(room,))
-        messages = [Message(offset=offset, roomname=roomname, username=username, 
-                            content=content, timestamp=ts) \
-                    for offset, roomname, username, content, ts in cur.fetchall()]
+        ''' Gets all the stored messages from this room (archived ones included) '''
+        return self.get_room_messages_since(room)
+
+    def get_room_messages_since(self, room, since=-1, limit=None):
+        ''' Gets the messages from this room with an offset higher than `since`, oldest first
+
+        The archived messages are read from the archive when the range includes them '''
+        if limit == 0:
+            return []
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('BEGIN')  # The archive index and the messages from the same snapshot
+            try:
+                messages = self._get_archived_messages(cur, room, since, limit)
+                if messages:
+                    since = messages[-1].offset
+                    if limit is not None:
+                        limit -= len(messages)
+                        if limit == 0:
+                            return messages
+                # LIMIT -1 means no limit in SQLite
+                cur.execute('''SELECT offset, roomname, username, content, timestamp
+                               FROM messages
+                               WHERE roomname = ? AND offset > ?
+                               ORDER BY offset
+                               LIMIT ?''', (room, since, -1 if limit is None else limit))
+                messages += [Message(offset=offset, roomname=roomname, username=username,
+                                     content=content, timestamp=ts) \
+                             for offset, roomname, username, content, ts in cur.fetchall()]
+                return messages
+            finally:
+                con.rollback()
+
+    def _get_archived_messages(self, cur, room, since, limit):
+        cur.execute('''SELECT path
+                       FROM archive_segments
+                       WHERE roomname = ? AND last_offset > ?
+                       ORDER BY first_offset''', (room, since))
+        messages = []
+        for path, in cur.fetchall():
+            for offset, username, content, ts in self.archive.read(path):
+                if offset > since:
+                    if limit is not None and len(messages) >= limit:
+                        return messages
+                    messages.append(Message(offset=offset, roomname=room, username=username,
+                                            content=content, timestamp=ts))
         return messages
 
-    def send_message(self, message):
-        ''' Send a message '''
-        cur = self.con.cursor()
+    def get_last_offsets(self):
+        ''' Gets a dict with the last offset used in each room that has messages '''
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('''SELECT roomname, MAX(offset)
+                           FROM messages
+                           GROUP BY roomname''')
+            return dict(cur.fetchall())
+
+    def get_last_offset(self, room):
+        ''' Gets the last offset used in the room, -1 if it has no messages '''
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('''SELECT COALESCE(MAX(offset), -1)
+                           FROM messages
+                           WHERE roomname = ?''', (room,))
+            return cur.fetchone()[0]
+
+    def get_room_tail(self, room, count):
+        ''' Gets the last `count` messages from this room, oldest first (never the archived ones) '''
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('''SELECT offset, roomname, username, content, timestamp
+                           FROM messages
+                           WHERE roomname = ?
+                           ORDER BY offset DESC
+                           LIMIT ?''', (room, count))
+            messages = [Message(offset=offset, roomname=roomname, username=username,
+                                content=content, timestamp=ts) \
+                        for offset, roomname, username, content, ts in reversed(cur.fetchall())]
+            return messages
+
+    ### Retention ###
+    def get_retention_policies(self):
+        ''' Gets a dict with rooms as keys and their (max_age, max_count) as values '''
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('''SELECT roomname, max_age, max_count
+                           FROM retention_policies''')
+            return {room: (max_age, max_count) for room, max_age, max_count in cur.fetchall()}
+
+    def set_retention_policy(self, room, max_age=None, max_count=None):
+        ''' Keeps the messages of the room up to `max_age` seconds and/or `max_count` messages
+        (None is no limit, with both None the room has no policy of its own) '''
+        with self.pool.writer() as con:
+            cur = con.cursor()
+            try:
+                if max_age is None and max_count is None:
+                    cur.execute('''DELETE FROM retention_policies WHERE roomname = ?''', (room,))
+                else:
+                    cur.execute('''INSERT OR REPLACE INTO retention_policies (roomname, max_age, max_count)
+                                   VALUES (?, ?, ?)''', (room, max_age, max_count))
+                con.commit()
+            except sqlite.Error as e:
+                log.error('Error setting the retention policy of room %s: %s', room, e)
+                return False
+            return True
+
+    def get_archive_cutoff(self, room, max_age=None, max_count=None):
+        ''' The highest offset of the room that is expired by the policy, None if there is none
+
+        The newest message of the room is never expired, the next offset is computed from it '''
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('''SELECT MAX(offset) FROM messages WHERE roomname = ?''', (room,))
+            last = cur.fetchone()[0]
+            if last is None:
+                return None
+            cutoffs = [-1]
+            if max_count is not None:
+                cutoffs.append(last - max_count)
+            now = time.time()
+            if max_age is not None and max_age < now:  # Otherwise older than the epoch, nothing is
+                cur.execute('''SELECT MAX(offset)
+                               FROM messages
+                               WHERE roomname = ? AND timestamp < ?''',
+                            (room, datetime.fromtimestamp(now - max_age)))
+                expired = cur.fetchone()[0]
+                cutoffs.append(-1 if expired is None else expired)
+            cutoff = min(max(cutoffs), last - 1)
+            return cutoff if cutoff >= 0 else None
+
+    def archive_messages(self, room, upto, segment_size=ARCHIVE_SEGMENT_SIZE):
+        ''' Moves the oldest messages of the room (up to offset `upto` and `segment_size` of them)
+        to a new segment of the archive, returns how many
+
+        The segment file is written (and fsynced) before taking the DB write lock, so the message
+        writer is only stalled by the transaction that checks the range, indexes it and deletes it '''
+        with self.pool.reader() as con:
+            cur = con.execute('''SELECT offset, username, content, timestamp
+                                 FROM messages
+                                 WHERE roomname = ? AND offset <= ?
+                                 ORDER BY offset
+                                 LIMIT ?''', (room, upto, segment_size))
+            rows = cur.fetchall()
+        if not rows:
+            return 0
+        first, last = rows[0][0], rows[-1][0]
         try:
-            cur.execute('''INSERT INTO messages (offset, roomname, username, content, timestamp)
-                       VALUES (?, ?, ?, ?, ?)''', (message.offset, message.roomname,
-                                                   message.username, message.content,
-                                                   message.timestamp))
-            self.con.commit()
-        except sqlite.Error as e:
-            print(f'Error sending message {message} in room {message.roomname}: {e}')
-            return -1
-        return True
+            path = self.archive.write(room, rows)
+        except OSError as e:
+            log.error('Error archiving the messages of room %s: %s', room, e)
+            return 0
+        with self.pool.writer() as con:
+            try:
+                con.execute('BEGIN IMMEDIATE')  # Nobody else can archive (or write) them meanwhile
+                cur = con.execute('''SELECT COUNT(*)
+                                     FROM messages
+                                     WHERE roomname = ? AND offset BETWEEN ? AND ?''', (room, first, last))
+                if cur.fetchone()[0] != len(rows):
+                    # Archived by another process (or the room deleted) since we read them
+                    cur = con.execute('''SELECT 1 FROM archive_segments WHERE roomname = ? AND path = ?''',
+                                      (room, path))
+                    indexed = cur.fetchone() is not None  # The same segment, its file is the one we wrote
+                    con.rollback()
+                    if not indexed:
+                        self.archive.discard(path)
+                    return 0
+                con.execute('''INSERT INTO archive_segments (roomname, first_offset, last_offset, count, path, created)
+                               VALUES (?, ?, ?, ?, ?, ?)''', (room, first, last, len(rows), path, time.time()))
+                con.execute('''DELETE FROM messages
+                               WHERE roomname = ? AND offset BETWEEN ? AND ?''', (room, first, last))
+                con.commit()
+            except sqlite.Error as e:
+                log.error('Error archiving the messages of room %s: %s', room, e)
+                con.rollback()
+                self.archive.discard(path)
+                return 0
+            MESSAGES_ARCHIVED.inc(len(rows))
+            return len(rows)
+
+    def get_archive_stats(self):
+        ''' Gets the number of segments and messages in the archive '''
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('''SELECT COUNT(*), COALESCE(SUM(count), 0) FROM archive_segments''')
+            segments, messages = cur.fetchone()
+            return {'archive_segments': segments, 'archived_messages': messages}
+
+    ### Search ###
+    def search_messages(self, text, room=None, username=None, since=None, until=None, before=None, limit=20):
+        ''' Searches the messages containing every word of `text`, newest first
+
+        Optionally only in a room, from a user and sent in [since, until) (datetimes).
+        Pagination: `before` is the cursor returned with the previous page.
+        Returns (messages, cursor of the next page or None if this is the last one) '''
+        query = search_query(text)
+        if not query:
+            return [], None
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('''SELECT messages_fts.rowid, offset, roomname, username, messages.content, timestamp
+                               FROM messages_fts
+                               JOIN messages ON messages.rowid = messages_fts.rowid
+                               WHERE messages_fts MATCH ?
+                                 AND (? IS NULL OR messages_fts.rowid < ?)
+                                 AND (? IS NULL OR roomname = ?)
+                                 AND (? IS NULL OR username = ?)
+                                 AND (? IS NULL OR timestamp >= ?)
+                                 AND (? IS NULL OR timestamp < ?)
+                               ORDER BY messages_fts.rowid DESC
+                               LIMIT ?''', (query, before, before, room, room, username, username,
+                                            since, since, until, until, limit + 1))
+                rows = cur.fetchall()
+            except sqlite.Error as e:
+                log.error('Error searching the messages with %s: %s', text, e)
+                return [], None
+        messages = [Message(offset=offset, roomname=roomname, username=username,
+                            content=content, timestamp=ts)
+                    for _, offset, roomname, username, content, ts in rows[:limit]]
+        # One more row than asked for tells whether there is a next page
+        cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return messages, cursor
+
+    ### Events ###
+    def add_event(self, origin, kind, roomname=None, username=None):
+        ''' Logs a change in the events table '''
+        with self.pool.writer() as con:
+            cur = con.cursor()
+            try:
+                cur.execute(INSERT_EVENT, (time.time(), origin, kind, roomname, username, None))
+                con.commit()
+            except sqlite.Error as e:
+                log.error('Error logging event %s of %s: %s', kind, origin, e)
+                return False
+            return True
+
+    def get_last_event_id(self):
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('SELECT COALESCE(MAX(id), 0) FROM events')
+            return cur.fetchone()[0]
+
+    def get_events_since(self, event_id, limit=1000):
+        ''' Gets the events after `event_id` (with the message of the 'message' ones), oldest first '''
+        with self.pool.reader() as con:
+            cur = con.cursor()
+            cur.execute('''SELECT events.id, events.origin, events.kind, events.roomname, events.username,
+                                  events.offset, messages.content, messages.timestamp
+                           FROM events
+                           LEFT JOIN messages ON events.kind = 'message'
+                                             AND messages.roomname = events.roomname
+                                             AND messages.offset = events.offset
+                           WHERE events.id > ?
+                           ORDER BY events.id
+                           LIMIT ?''', (event_id, limit))
+            events = [Event(id=id, origin=origin, kind=kind, roomname=roomname, username=username,
+                            message=Message(offset=offset, roomname=roomname, username=username,
+                                            content=content, timestamp=ts) if kind == 'message' else None) \
+                      for id, origin, kind, roomname, username, offset, content, ts in cur.fetchall()]
+            return events
+
+    def prune_events(self, older_than):
+        ''' Deletes the events created before the `older_than` timestamp '''
+        with self.pool.writer() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('DELETE FROM events WHERE created < ?', (older_than,))
+                con.commit()
+            except sqlite.Error as e:
+                log.error('Error pruning events: %s', e)
+                return False
+            return True
+
+    ### Message writer ###
+    def submit_message(self, message, on_stored=None):
+        ''' Enqueues a message to be written, returns a PendingWrite to wait for it
+
+        Messages are committed in the order they are submitted, `on_stored(message)` is
+        called from the writer thread once it is committed '''
+        return self.message_writer.submit(message, on_stored)
+
+    def submit_messages(self, messages, on_stored=None):
+        ''' Same as submit_message for many messages, written in a single transaction (all or none of them)
+
+        Returns a PendingWrite per message '''
+        return self.message_writer.submit_many(messages, on_stored)
+
+    def send_message(self, message, durable=True):
+        ''' Send a message
+
+        With `durable` this waits until the message is committed and returns whether it was stored,
+        otherwise it returns as soon as it is enqueued (fire and forget) '''
+        pending = self.submit_message(message)
+        if not durable:
+            return True
+        return pending.wait()
+
+    def writer_backlog(self):
+        ''' Number of submitted messages that are not written yet '''
+        return self.message_writer.backlog()
+
+    def stats(self):
+        ''' Connection pool and message writer metrics '''
+        return dict(self.pool.stats(), writer_backlog=self.message_writer.backlog(),
+                    search_backfill_remaining=self.search_backfill.remaining(),
+                    **self.get_archive_stats())
+
     def close(self):
-        self.con.close()
+        self.search_backfill.stop()
+        self.message_writer.stop()
+        self.pool.close()
 
 
 db = None
@@ -0,0 +1,79 @@
+'''
+Wire formats of the messages sent by /message/get and /message/get_many
+
+The client picks them with the usual headers:
+
+ Accept: the layout of the body
+   application/json (default): every message is an object with its keys
+   application/vnd.zero-chat.columns+json: the messages of a room by columns, without the keys
+       repeated in every message: "offsets": [...], "usernames": [...], "contents": [...], "timestamps": [...]
+   application/msgpack: the same columns in MessagePack (if msgpack is installed)
+ Accept-Encoding: br (if brotli is installed) or gzip, only for bodies of COMPRESS_MIN_SIZE or more
+
+Every combination is a different variant in the response cache (see responses.py), so the
+messages of a room are encoded and compressed once per format until the room changes
+'''
+import gzip
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = 1024  # Smaller bodies are sent as they are, compressing them is not worth it
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5        # The default (11) is too slow to compress every response
+
+JSON = 'json'
+COLUMNS = 'columns'
+MSGPACK = 'msgpack'
+MEDIA_TYPES = {JSON: 'application/json',
+               COLUMNS: 'application/vnd.zero-chat.columns+json',
+               MSGPACK: 'application/msgpack'}
+VARY = 'Accept, Accept-Encoding'  # The headers the answers depend on
+
+
+def available_formats():
+    return [fmt for fmt in MEDIA_TYPES if fmt != MSGPACK or msgpack is not None]
+
+def available_codings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def negotiate(accept, accept_encoding):
+    ''' The (format, content coding) to answer a client, from its Accept and Accept-Encoding
+    headers (parsed by werkzeug, e.g. request.accept_mimetypes and request.accept_encodings)
+
+    The content coding is None when the client accepts none of ours '''
+    formats = available_formats()
+    media_type = accept.best_match([MEDIA_TYPES[fmt] for fmt in formats], default=MEDIA_TYPES[JSON])
+    fmt = next(fmt for fmt in formats if MEDIA_TYPES[fmt] == media_type)
+    return fmt, accept_encoding.best_match(available_codings())
+
+def from_columns(body, fmt):
+    ''' Converts a body in the columns format (JSON) to `fmt` (COLUMNS or MSGPACK) '''
+    if fmt == MSGPACK:
+        return msgpack.packb(json.loads(body))
+    return body
+
+def compress(body, coding, min_size=COMPRESS_MIN_SIZE):
+    ''' Returns (body, content coding), the body is only compressed if it is big enough '''
+    if coding is None or len(body) < min_size:
+        return body, None
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY), coding
+    return gzip.compress(body, GZIP_LEVEL, mtime=0), coding
+
+def response_headers(etag=None, coding=None):
+    ''' The headers of an answer in a negotiated format '''
+    headers = {'Vary': VARY}
+    if etag is not None:
+        headers['ETag'] = etag
+    if coding is not None:
+        headers['Content-Encoding'] = coding
+    return headers
@@ -0,0 +1,92 @@
+'''
+In-memory index of which users have joined which rooms, in both directions
+
+The server needs the users of a room (to check who can send a message to it, /joined_room/all)
+and the rooms of a user (/joined_room/list, the answers of join and leave, deleting a user),
+so both are kept in memory and updated together, and reading a membership never goes to the DB
+'''
+import threading
+
+
+class MembershipIndex:
+    ''' The existing rooms with their joined users, and the users with their joined rooms
+
+    For reading it works like a dict with rooms as keys and the set of their joined users as
+    values (those sets must not be modified, every change goes through the methods) '''
+    def __init__(self, rooms=(), memberships=()):
+        self._lock = threading.Lock()
+        self._users_of = {room: set() for room in rooms}  # A dict with rooms as keys and a set of users
+        self._rooms_of = {}                                # A dict with users as keys and a set of rooms
+        for room, user in memberships:
+            self._add(user, room)
+
+    def __contains__(self, room):
+        return room in self._users_of
+
+    def __getitem__(self, room):
+        return self._users_of[room]
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._users_of))
+
+    def __len__(self):
+        return len(self._users_of)
+
+    def items(self):
+        ''' A snapshot of (room, users) pairs '''
+        with self._lock:
+            return [(room, set(users)) for room, users in self._users_of.items()]
+
+    def rooms_of(self, user):
+        ''' The rooms the user has joined '''
+        with self._lock:
+            return sorted(self._rooms_of.get(user, ()))
+
+    def add_room(self, room):
+        ''' Adds a room without users (nothing changes if it exists) '''
+        with self._lock:
+            self._users_of.setdefault(room, set())
+
+    def remove_room(self, room):
+        ''' Removes the room and its memberships '''
+        with self._lock:
+            for user in self._users_of.pop(room, ()):
+                self._discard(user, room)
+
+    def add(self, user, room):
+        ''' Joins the user to the room, returns False if the room does not exist '''
+        with self._lock:
+            if room not in self._users_of:
+                return False
+            self._add(user, room)
+            return True
+
+    def remove(self, user, room):
+        ''' Removes the user from the room, returns False if the user had not joined it '''
+        with self._lock:
+            users = self._users_of.get(room)
+            if users is None or user not in users:
+                return False
+            users.discard(user)
+            self._discard(user, room)
+            return True
+
+    def remove_user(self, user):
+        ''' Removes every membership of the user, returns the rooms it had joined '''
+        with self._lock:
+            rooms = self._rooms_of.pop(user, set())
+            for room in rooms:
+                self._users_of[room].discard(user)
+            return sorted(rooms)
+
+    def _add(self, user, room):
+        self._users_of.setdefault(room, set()).add(user)
+        self._rooms_of.setdefault(user, set()).add(room)
+
+    def _discard(self, user, room):
+        rooms = self._rooms_of.get(user)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self._rooms_of[user]
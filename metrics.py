@@ -0,0 +1,269 @@
+'''
+Metrics of the server, exposed in the Prometheus text format on /metrics
+
+Counter, Gauge and Histogram are small thread-safe versions of the ones in prometheus_client
+(which is not needed). They are created through a Registry, that renders all of them.
+
+Values that already live somewhere else (the sizes of the caches, the stats of the connection
+pool...) are not copied into gauges every time they change: a collector, a function registered
+with `Registry.collector`, reads them when /metrics is scraped.
+
+SamplingProfiler is a (very) poor man's profiler for production: a thread that takes the stack
+of every other thread every few milliseconds, to see where the time goes without the overhead
+of cProfile. Its report is in the "collapsed stacks" format used to draw flame graphs.
+'''
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from functools import wraps
+
+# Upper bounds (seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PROFILE_INTERVAL = 0.005  # Default seconds between two samples of the SamplingProfiler
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    ''' A metric with a value per combination of its labels '''
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # A dict with the tuples of label values as keys
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} has the labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        ''' Yields (name, labels, value) for every line of this metric '''
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    ''' A value that only goes up '''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    ''' A value that goes up and down '''
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    ''' Counts the observed values in buckets, plus their sum and count '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                # The count of every bucket (not cumulative), then the sum
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[bisect_left(self.buckets, value)] += 1
+            values[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        ''' Observes the seconds spent in the block '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in values:
+            labels = dict(zip(self.labelnames, key))
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield f'{self.name}_bucket', dict(labels, le=format_value(bound)), total
+            yield f'{self.name}_sum', labels, counts[-1]
+            yield f'{self.name}_count', labels, total
+
+
+class Registry:
+    ''' All the metrics (and collectors) rendered on /metrics '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                return self._metrics[metric.name]  # Modules imported twice (e.g. as __main__) share them
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, function):
+        ''' Registers `function()`, called on every render, that returns a list of
+        (name, kind, help, [(labels, value), ...]) with the current values of some metrics '''
+        with self._lock:
+            self._collectors.append(function)
+        return function
+
+    def render(self):
+        ''' All the metrics in the Prometheus text format '''
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        families = [(metric.name, metric.kind, metric.help, metric.samples()) for metric in metrics]
+        for collector in collectors:
+            for name, kind, help, values in collector():
+                families.append((name, kind, help, [(name, labels, value) for labels, value in values]))
+        lines = []
+        for name, kind, help, samples in families:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{sample}{format_labels(labels)} {format_value(value)}' for sample, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()  # The registry of the server
+
+
+def instrument_methods(histogram, label='method'):
+    ''' Class decorator: observes in `histogram` the seconds spent in every public method of the class '''
+    def decorate(cls):
+        for name, function in list(vars(cls).items()):
+            if name.startswith('_') or not callable(function):
+                continue
+            setattr(cls, name, timed_function(function, histogram, **{label: name}))
+        return cls
+    return decorate
+
+def timed_function(function, histogram, **labels):
+    @wraps(function)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start, **labels)
+    return timed
+
+
+class SamplingProfiler:
+    ''' Samples the stack of every thread from a background thread while it is running '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.interval = PROFILE_INTERVAL
+        self.stacks = StackCounter()  # Times every collapsed stack was seen
+        self.samples = 0
+        self.started = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=PROFILE_INTERVAL):
+        ''' Starts sampling (from scratch) every `interval` seconds, returns False if it was running '''
+        with self._lock:
+            if self.running:
+                return False
+            self.interval = interval
+            self.stacks = StackCounter()
+            self.samples = 0
+            self.started = time.time()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        ''' Stops sampling, returns False if it was not running '''
+        with self._lock:
+            if not self.running:
+                return False
+            self._stopped.set()
+            self._thread.join()
+            return True
+
+    def report(self, limit=None):
+        ''' The sampled stacks as "frame;frame;frame count" lines, most frequent first '''
+        with self._lock:
+            stacks = self.stacks.most_common(limit)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stopped.wait(self.interval):
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks.append(';'.join(reversed(stack)))
+            with self._lock:
+                self.stacks.update(stacks)
+                self.samples += 1
@@ -0,0 +1,175 @@
+'''
+This is a very small in-process publish/subscribe module used to push
+the new messages to the clients instead of making them poll the server
+
+Every subscriber listens to a set of rooms and gets its own bounded queue.
+Publishing never blocks: if a subscriber queue is full it is considered a slow
+consumer and gets disconnected, so one laggard cannot stall the delivery to
+everybody else (the client is expected to reconnect and catch up using
+/message/get/<roomname>?since=<offset>)
+
+The Broker also keeps a condition per room so long-polling requests can sleep
+until something is published in the room they are waiting on
+
+Publishing is always done from regular threads, but subscribers and long-pollers
+can live in an asyncio event loop too (see AsyncSubscriber and Broker.wait_async)
+'''
+import asyncio
+import logging
+import queue
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 256  # Max number of pending messages per subscriber
+
+
+class Subscriber:
+    ''' A client listening to some rooms '''
+    def __init__(self, rooms, queue_size=DEFAULT_QUEUE_SIZE):
+        self.rooms = set(rooms)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.closed = False
+
+    def offer(self, message):
+        ''' Enqueue the message without blocking, returns False if the queue is full '''
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            return False
+        return True
+
+    def get(self, timeout=None):
+        ''' Waits for the next message, returns None on timeout '''
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncSubscriber(Subscriber):
+    ''' A Subscriber consumed from an asyncio event loop
+
+    Messages are handed to the loop thread-safely, so the slow consumer check
+    happens in the loop when the message is actually enqueued '''
+    def __init__(self, rooms, queue_size, broker):
+        self.rooms = set(rooms)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.closed = False
+        self._loop = asyncio.get_running_loop()
+        self._broker = broker
+
+    def offer(self, message):
+        self._loop.call_soon_threadsafe(self._put, message)
+        return True
+
+    def _put(self, message):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            log.warning('Disconnecting slow subscriber of rooms %s', self.rooms)
+            self._broker.dropped += 1
+            self._broker.unsubscribe(self)
+
+    async def get(self, timeout=None):
+        ''' Waits for the next message, returns None on timeout '''
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Broker:
+    ''' Fans out the published messages to the subscribers of each room '''
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = {}  # A dict with rooms as keys and a set of subscribers as values
+        self._conditions = {}   # A dict with rooms as keys and the Condition long-pollers wait on
+        self._async_waiters = {} # A dict with rooms as keys and a set of (loop, Event) of asyncio long-pollers
+        self.dropped = 0        # Number of slow consumers we had to disconnect
+
+    def subscribe(self, rooms):
+        ''' Returns a new Subscriber listening to all the rooms '''
+        return self._add(Subscriber(rooms, self.queue_size))
+
+    def subscribe_async(self, rooms):
+        ''' Returns a new AsyncSubscriber listening to all the rooms, must be called from the event loop '''
+        return self._add(AsyncSubscriber(rooms, self.queue_size, self))
+
+    def _add(self, subscriber):
+        with self._lock:
+            for room in subscriber.rooms:
+                self._subscribers.setdefault(room, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            for room in subscriber.rooms:
+                subscribers = self._subscribers.get(room)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self._subscribers[room]
+        subscriber.close()
+
+    def wait(self, room, predicate, timeout):
+        ''' Blocks until `predicate()` is true or the timeout expires, returns the last value of `predicate()`
+
+        The predicate is checked again every time a message is published in the room '''
+        with self._lock:
+            condition = self._conditions.setdefault(room, threading.Condition())
+        with condition:
+            return condition.wait_for(predicate, timeout)
+
+    async def wait_async(self, room, predicate, timeout):
+        ''' Same as `wait` but for coroutines, it does not block the event loop '''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not predicate():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            waiter = (loop, asyncio.Event())
+            with self._lock:
+                self._async_waiters.setdefault(room, set()).add(waiter)
+            try:
+                if predicate():  # Published before we registered the waiter
+                    break
+                await asyncio.wait_for(waiter[1].wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._lock:
+                    waiters = self._async_waiters.get(room)
+                    if waiters is not None:
+                        waiters.discard(waiter)
+                        if not waiters:
+                            del self._async_waiters[room]
+        return predicate()
+
+    def publish(self, message):
+        ''' Sends the message to every subscriber of its room and wakes up the long-pollers '''
+        with self._lock:
+            subscribers = list(self._subscribers.get(message.roomname, ()))
+            condition = self._conditions.get(message.roomname)
+            async_waiters = list(self._async_waiters.get(message.roomname, ()))
+        if condition is not None:
+            with condition:
+                condition.notify_all()
+        for loop, event in async_waiters:
+            loop.call_soon_threadsafe(event.set)
+        for subscriber in subscribers:
+            if not subscriber.offer(message):
+                log.warning('Disconnecting slow subscriber of rooms %s', subscriber.rooms)
+                self.dropped += 1
+                self.unsubscribe(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({subscriber for subscribers in self._subscribers.values() for subscriber in subscribers})
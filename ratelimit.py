@@ -0,0 +1,75 @@
+'''
+Token bucket rate limits, kept in memory
+
+Every key of a kind (every user, every room...) has a bucket of `burst` tokens that refills at
+`rate` tokens per second, and a request takes some tokens (e.g. one per message sent) from each
+of its buckets. A request is admitted only if all its buckets have them, otherwise none is
+taken and the request is told how long to wait.
+
+A request that costs more than `burst` is admitted once its bucket is full, and leaves it in
+debt (the next requests wait until it is paid), so big batches are slowed down but never stuck.
+
+The buckets live in the memory of each server process: with several processes (see backend.py)
+the limits apply per process.
+'''
+import threading
+import time
+
+PRUNE_INTERVAL = 60  # Seconds between two scans that drop the buckets that are full again
+
+
+class RateLimiter:
+    ''' Token buckets of several kinds of keys, checked together
+
+    `limits` has the kinds as keys and their (rate, burst) as values, a kind with None
+    as its limit is not limited '''
+    def __init__(self, **limits):
+        self.limits = {kind: limit for kind, limit in limits.items() if limit is not None}
+        self._lock = threading.Lock()
+        self._buckets = {kind: {} for kind in self.limits}  # Per kind, a dict with keys and their (tokens, time)
+        self._pruned = time.monotonic()
+
+    def acquire(self, costs):
+        ''' Takes the tokens in `costs`, a dict with (kind, key) as keys and the number of tokens as values,
+        all or none of them
+
+        Returns (None, 0) if they were taken, otherwise the first kind short of tokens and
+        the seconds until it has them '''
+        now = time.monotonic()
+        with self._lock:
+            taken = []
+            for (kind, key), cost in costs.items():
+                if kind not in self.limits:
+                    continue
+                rate, burst = self.limits[kind]
+                tokens = self._tokens(kind, key, now)
+                needed = min(cost, burst)
+                if tokens < needed:
+                    return kind, (needed - tokens) / rate
+                taken.append((kind, key, tokens - cost))
+            for kind, key, tokens in taken:
+                self._buckets[kind][key] = (tokens, now)
+            if now - self._pruned > PRUNE_INTERVAL:
+                self._prune(now)
+        return None, 0
+
+    def stats(self):
+        ''' Number of buckets of every kind '''
+        with self._lock:
+            return {kind: len(buckets) for kind, buckets in self._buckets.items()}
+
+    def _tokens(self, kind, key, now):
+        rate, burst = self.limits[kind]
+        bucket = self._buckets[kind].get(key)
+        if bucket is None:
+            return burst
+        tokens, last = bucket
+        return min(burst, tokens + (now - last) * rate)
+
+    def _prune(self, now):
+        ''' Drops the buckets that are full, a missing bucket is a full one '''
+        for kind, buckets in self._buckets.items():
+            burst = self.limits[kind][1]
+            for key in [key for key in buckets if self._tokens(kind, key, now) >= burst]:
+                del buckets[key]
+        self._pruned = now
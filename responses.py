@@ -0,0 +1,85 @@
+'''
+Cache of the encoded JSON bodies of the hot read endpoints
+
+Every cached resource (the users list, the rooms list, the messages of a room...) is
+identified by a key with a generation number that is bumped whenever the resource
+changes. The encoded bodies are kept until the generation of their key changes, and
+the generation is also the ETag of the response, so a client polling something that
+did not change gets a 304 without the server even looking at the data.
+
+orjson is used to encode when it is installed, it is several times faster than json
+'''
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MAX_VARIANTS = 32  # Max bodies cached per key (e.g. different `since` of the same room)
+
+
+def dumps(obj):
+    ''' Encodes obj as compact UTF-8 JSON '''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def etag_matches(if_none_match, etag):
+    ''' True if the If-None-Match header has the etag '''
+    if not if_none_match:
+        return False
+    return any(tag.strip() in (etag, '*') for tag in if_none_match.split(','))
+
+
+class ResponseCache:
+    ''' Encoded bodies by key and variant, invalidated by bumping the generation of the key '''
+    def __init__(self, max_variants=MAX_VARIANTS):
+        self.max_variants = max_variants
+        # Changes on every start so an ETag of a previous run (or another process) never matches
+        self.epoch = f'{os.getpid():x}{int(time.time() * 1000):x}'
+        self._lock = threading.Lock()
+        self._generations = {}  # A dict with keys as keys and their generation as values
+        self._bodies = {}       # A dict with keys as keys and an OrderedDict of variant: (generation, body)
+        self.hits = 0
+        self.misses = 0
+
+    def bump(self, *keys):
+        ''' The resources of these keys changed '''
+        with self._lock:
+            for key in keys:
+                self._generations[key] = self._generations.get(key, 0) + 1
+                self._bodies.pop(key, None)
+
+    def etag(self, key, variant=''):
+        return f'"{self.epoch}.{self._generations.get(key, 0)}.{variant}"'
+
+    def get(self, key, variant, build):
+        ''' The body for the key and variant, `build()` returns the encoded body if it is not cached '''
+        with self._lock:
+            generation = self._generations.get(key, 0)
+            cached = self._bodies.get(key, {}).get(variant)
+            if cached is not None and cached[0] == generation:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        body = build()
+        with self._lock:
+            if self._generations.get(key, 0) == generation:  # Did not change while we were building it
+                bodies = self._bodies.setdefault(key, OrderedDict())
+                bodies[variant] = (generation, body)
+                if len(bodies) > self.max_variants:
+                    bodies.popitem(last=False)
+        return body
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._generations),
+                    'bodies': sum(len(bodies) for bodies in self._bodies.values()),
+                    'hits': self.hits,
+                    'misses': self.misses}
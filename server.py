@@ -7,54 +7,285 @@ NOTE: This is not optimized whatsoever, it's just for teaching purposes
 This resembles a REST API, but does not necessarily adhere to the spec,
 this is quick and dirty
 '''
-from flask import Flask, jsonify, request, abort, make_response, escape
+from flask import Flask, jsonify, request, abort, make_response, Response, stream_with_context, g
+from werkzeug.exceptions import TooManyRequests
 # from collections import namedtuple
+from collections import Counter
 from datetime import datetime
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+import formats
+import metrics
 from db import DB, Message
+from pubsub import Broker
+from cache import MessageCache
+from membership import MembershipIndex
+from backend import make_backend
+from archive import Archiver
+from ratelimit import RateLimiter
+from responses import ResponseCache, dumps, etag_matches
 app = Flask(__name__)
 
 UNAUTHORIZED_ERROR = 401
 NOT_FOUND_ERROR = 404
 ALREADY_EXISTS_ERROR = 409
 UNPROCESSABLE_ENTITY_ERROR = 422
+TOO_MANY_REQUESTS_ERROR = 429
 INTERNAL_SERVER_ERROR = 500
+SERVICE_UNAVAILABLE_ERROR = 503
 
+# DEBUG logs every message sent
+logging.basicConfig(level=os.environ.get('ZERO_CHAT_LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+log = logging.getLogger(__name__)
 
 # Global objects
 # FIXME: Use an Application Context here to thread safely use these caches
 db = DB()
 cached_users = None    # Just a set with all the users for quick membership check
-cached_rooms = None    # A dict with rooms as keys and a set of joined users as values
-cached_messages = None # A dict with rooms as keys and list of messages as values
+cached_rooms = None    # A MembershipIndex with the users of every room and the rooms of every user
+cached_messages = None # A MessageCache with the most recent messages of the most used rooms
 room_offsets = None    # A dict with the last offset stored in the room
+allocated_offsets = None # A dict with the last offset handed out in the room (ahead of room_offsets while it is being written)
+broker = Broker()      # Pushes the new messages to the clients subscribed to /message/stream
+response_cache = ResponseCache()  # Encoded bodies of the hot read endpoints, see responses.py
+
+# Keys of the response_cache, their generation has to be bumped every time they change
+USERS_KEY = 'users'
+ROOMS_KEY = 'rooms'
+MEMBERSHIPS_KEY = 'memberships'
+
+def messages_key(roomname):
+    return f'messages:{roomname}'
+
+STREAM_KEEPALIVE = 15  # Seconds between keepalive comments on idle streams
+MAX_POLL_WAIT = 30     # Max seconds a long-polling /message/get request is held
+SEND_DURABLE = True    # Answer /message/send once the message is committed (False: once it is enqueued)
+SEND_TIMEOUT = 30      # Max seconds a durable send waits for the commit, then it is answered with a 503
+ROOM_LOCK_SHARDS = 64  # Number of locks the rooms are spread over
+# How the state is shared with other server processes (see backend.py):
+# 'local' for a single process, 'sqlite' for several processes on the same DB
+STATE_BACKEND = os.environ.get('ZERO_CHAT_BACKEND', 'local')
+CACHE_ROOM_CAPACITY = 1000            # Messages kept in memory per room
+CACHE_MAX_BYTES = 64 * 1024 * 1024    # Memory budget for all the cached messages
+SEARCH_PAGE_SIZE = 20                 # Default number of results of /message/search
+SEARCH_MAX_PAGE_SIZE = 100
+# Retention of the rooms without a policy of their own (see /room/retention), None is no limit
+RETENTION_MAX_AGE = None      # Seconds
+RETENTION_MAX_COUNT = None    # Messages
+MAX_RETENTION_AGE = 100 * 365 * 24 * 3600  # The longest max_age /room/retention accepts (seconds)
+# Rate limits of the messages sent (/message/send and /message/send_many) as
+# (messages per second, burst), None is no limit. See ratelimit.py
+SEND_USER_LIMIT = (20, 100)    # Per user
+SEND_ROOM_LIMIT = (500, 2000)  # Per room
+MAX_WRITE_BACKLOG = 10000      # Messages waiting for the DB writer above which the sends are rejected (None is no limit)
+BACKLOG_RETRY_AFTER = 1        # Seconds the clients are told to wait when the DB writer is behind
+PROFILING = os.environ.get('ZERO_CHAT_PROFILING', '0') != '0'  # Enables the /profile routes
+
+backend = make_backend(STATE_BACKEND, db)  # Keeps the caches in sync with the other server processes
+archiver = Archiver(db, (RETENTION_MAX_AGE, RETENTION_MAX_COUNT))  # Moves the expired messages to the archive
+send_limiter = RateLimiter(user=SEND_USER_LIMIT, room=SEND_ROOM_LIMIT)
+
+# Every room is guarded by one of these locks (picked by hash), it must be held to hand out
+# offsets in the room or to change its entries in cached_rooms, room_offsets and allocated_offsets.
+# Rooms that fall in different shards never wait for each other
+# The DB can be written while holding them: the DB writer thread only takes them (in message_stored)
+# once it has released the DB write lock
+room_locks = [threading.Lock() for _ in range(ROOM_LOCK_SHARDS)]
+
+def room_lock(roomname):
+    ''' The lock guarding this room '''
+    return room_locks[hash(roomname) % ROOM_LOCK_SHARDS]
+
+@contextmanager
+def rooms_lock(roomnames):
+    ''' Holds the locks of all these rooms, taken in shard order so two of these can never deadlock '''
+    shards = sorted({hash(roomname) % ROOM_LOCK_SHARDS for roomname in roomnames})
+    for shard in shards:
+        room_locks[shard].acquire()
+    try:
+        yield
+    finally:
+        for shard in reversed(shards):
+            room_locks[shard].release()
 
 def init_cache():
-    ''' Initialize the cache '''
+    ''' Initialize the cache
+
+    This runs a fixed number of queries no matter how big the DB is: the messages
+    themselves are loaded lazily by the MessageCache the first time a room is read '''
     global cached_users
     global cached_rooms
     global cached_messages
     global room_offsets
+    global allocated_offsets
+    backend.begin_snapshot()
     cached_users = set(db.get_users())
-    cached_messages = {}
-    room_offsets = {}
+    cached_messages = MessageCache(db, room_capacity=CACHE_ROOM_CAPACITY, max_bytes=CACHE_MAX_BYTES)
 
     # Init the rooms cache
-    cached_rooms = {room: set() for room in db.get_rooms()}
-    for room in cached_rooms: # FIXME: This can be done faster directly in a SQL Join
-        joined_users = db.get_joined_users(room)
-        for username in joined_users:
-            if username in cached_users:
-                cached_rooms[room].add(username)
-            else:
-                # WTF should not happen, since it's forced by FK?
-                print('INIT ERROR: Joined user not in Cached Users?')
-                return False
-        # Init the messages cache
-        messages = db.get_room_messages(room)
-        cached_messages[room] = messages
-        room_offsets[room] = max([message.offset for message in messages]) if messages else -1
+    memberships = db.get_all_joined_users()
+    if any(username not in cached_users for room, username in memberships):
+        # WTF should not happen, since it's forced by FK?
+        log.error('INIT ERROR: Joined user not in Cached Users?')
+        return False
+    cached_rooms = MembershipIndex(db.get_rooms(), memberships)
+    # Only the last offset of each room is needed to keep sending messages
+    last_offsets = db.get_last_offsets()
+    room_offsets = {room: last_offsets.get(room, -1) for room in cached_rooms}
+    allocated_offsets = dict(room_offsets)
+    response_cache.bump(USERS_KEY, ROOMS_KEY, MEMBERSHIPS_KEY, *map(messages_key, cached_rooms))
+    backend.start(apply_event)
+    archiver.start()
     return True
 
+def apply_event(event):
+    ''' Applies to the caches a change made by another server process (see backend.py) '''
+    if event.kind == 'message':
+        message_stored(event.message)
+    elif event.kind == 'user_created':
+        cached_users.add(event.username)
+        response_cache.bump(USERS_KEY)
+    elif event.kind == 'user_deleted':
+        cached_users.discard(event.username)
+        cached_rooms.remove_user(event.username)
+        response_cache.bump(USERS_KEY, MEMBERSHIPS_KEY)
+    elif event.kind == 'room_created':
+        with room_lock(event.roomname):
+            cached_rooms.add_room(event.roomname)
+            room_offsets.setdefault(event.roomname, -1)
+            allocated_offsets.setdefault(event.roomname, -1)
+        response_cache.bump(ROOMS_KEY, MEMBERSHIPS_KEY, messages_key(event.roomname))
+    elif event.kind == 'room_deleted':
+        forget_room(event.roomname)
+    elif event.kind == 'joined':
+        with room_lock(event.roomname):
+            cached_rooms.add(event.username, event.roomname)
+        response_cache.bump(MEMBERSHIPS_KEY)
+    elif event.kind == 'left':
+        with room_lock(event.roomname):
+            cached_rooms.remove(event.username, event.roomname)
+        response_cache.bump(MEMBERSHIPS_KEY)
+
+
+### Metrics ###
+REQUEST_SECONDS = metrics.REGISTRY.histogram('zero_chat_request_seconds', 'Seconds to answer a request',
+                                             ['route', 'method', 'status'])
+REQUESTS_IN_FLIGHT = metrics.REGISTRY.gauge('zero_chat_requests_in_flight', 'Requests being answered', ['route'])
+SENDS_REJECTED = metrics.REGISTRY.counter('zero_chat_sends_rejected_total', 'Send requests rejected with a 429',
+                                          ['reason'])  # 'user' or 'room' (rate limit), or 'backlog' (DB writer)
+profiler = metrics.SamplingProfiler()
+
+def request_route():
+    ''' The rule of the route of the request (not its path, so the metrics have few labels) '''
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc(route=request_route())
+
+@app.after_request
+def finish_request(response):
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, route=request_route(),
+                            method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+def end_request(error=None):
+    REQUESTS_IN_FLIGHT.dec(route=request_route())
+
+@metrics.REGISTRY.collector
+def collect_state():
+    ''' The sizes of the caches and the stats of the DB, read when /metrics is scraped '''
+    families = [('zero_chat_users', 'gauge', 'Existing users', [({}, len(cached_users or ()))]),
+                ('zero_chat_rooms', 'gauge', 'Existing rooms', [({}, len(cached_rooms or ()))]),
+                ('zero_chat_stream_subscribers', 'gauge', 'Clients connected to /message/stream',
+                 [({}, broker.subscriber_count())]),
+                ('zero_chat_stream_dropped_total', 'counter', 'Slow stream clients disconnected',
+                 [({}, broker.dropped)]),
+                ('zero_chat_rate_limit_buckets', 'gauge', 'Token buckets of the send rate limits',
+                 [({'kind': kind}, count) for kind, count in send_limiter.stats().items()])]
+    if cached_messages is not None:
+        cache = cached_messages.stats()
+        families += [('zero_chat_cache_rooms', 'gauge', 'Rooms in the messages cache', [({}, cache['rooms'])]),
+                     ('zero_chat_cache_messages', 'gauge', 'Messages in the messages cache', [({}, cache['messages'])]),
+                     ('zero_chat_cache_bytes', 'gauge', 'Bytes used by the messages cache', [({}, cache['bytes'])]),
+                     ('zero_chat_cache_requests_total', 'counter', 'Reads of the messages cache',
+                      [({'result': 'hit'}, cache['hits']), ({'result': 'miss'}, cache['misses'])]),
+                     ('zero_chat_cache_evictions_total', 'counter', 'Rooms evicted from the messages cache',
+                      [({}, cache['evictions'])])]
+    responses = response_cache.stats()
+    families += [('zero_chat_response_cache_bodies', 'gauge', 'Encoded bodies in the responses cache',
+                  [({}, responses['bodies'])]),
+                 ('zero_chat_response_cache_requests_total', 'counter', 'Reads of the responses cache',
+                  [({'result': 'hit'}, responses['hits']), ({'result': 'miss'}, responses['misses'])])]
+    stats = db.stats()
+    families += [('zero_chat_db_readers_open', 'gauge', 'Reader connections open', [({}, stats['readers_open'])]),
+                 ('zero_chat_db_readers_idle', 'gauge', 'Reader connections not in use', [({}, stats['readers_idle'])]),
+                 ('zero_chat_db_waits_total', 'counter', 'Checkouts of a connection that had to wait',
+                  [({'connection': 'reader'}, stats['reader_waits']), ({'connection': 'writer'}, stats['writer_waits'])]),
+                 ('zero_chat_db_wait_seconds_total', 'counter', 'Seconds spent waiting for a connection',
+                  [({'connection': 'reader'}, stats['reader_wait_time']),
+                   ({'connection': 'writer'}, stats['writer_wait_time'])]),
+                 ('zero_chat_db_writer_backlog', 'gauge', 'Messages waiting for the message writer',
+                  [({}, stats['writer_backlog'])]),
+                 ('zero_chat_db_search_backfill_remaining', 'gauge', 'Messages waiting to be indexed for search',
+                  [({}, stats['search_backfill_remaining'])]),
+                 ('zero_chat_archive_segments', 'gauge', 'Segment files in the archive', [({}, stats['archive_segments'])]),
+                 ('zero_chat_archive_messages', 'gauge', 'Messages in the archive', [({}, stats['archived_messages'])])]
+    return families
+
+@app.route("/metrics")
+def metrics_endpoint():
+    ''' The metrics of the server in the Prometheus text format '''
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+def start_profiler(args):
+    if not PROFILING:
+        abort(NOT_FOUND_ERROR)
+    interval = args.get('interval', metrics.PROFILE_INTERVAL, type=float)
+    if interval <= 0:
+        abort(UNPROCESSABLE_ENTITY_ERROR)
+    return {'started': profiler.start(interval), 'interval': profiler.interval}
+
+def stop_profiler():
+    if not PROFILING:
+        abort(NOT_FOUND_ERROR)
+    return {'stopped': profiler.stop(), 'samples': profiler.samples}
+
+def profiler_report(args):
+    if not PROFILING:
+        abort(NOT_FOUND_ERROR)
+    return profiler.report(args.get('limit', None, type=int))
+
+@app.route("/profile/start", methods=['POST'])
+def profile_start():
+    ''' Starts the sampling profiler (only with ZERO_CHAT_PROFILING=1)
+
+    Query params:
+     interval: seconds between two samples (default: metrics.PROFILE_INTERVAL)
+    '''
+    return jsonify(start_profiler(request.args))
+
+@app.route("/profile/stop", methods=['POST'])
+def profile_stop():
+    return jsonify(stop_profiler())
+
+@app.route("/profile")
+def profile():
+    ''' The stacks sampled by the profiler, as collapsed stacks (the input of flamegraph.pl)
+
+    Query params:
+     limit: only the most frequent stacks
+    '''
+    return Response(profiler_report(request.args), mimetype='text/plain')
+
 
 @app.route("/")
 def root():
@@ -62,8 +293,7 @@ def root():
 
 @app.route("/admin")
 def unauthorized(arg):
-    print(arg)
-    print(dir(arg))
+    log.debug('%s %s', arg, dir(arg))
     abort(UNAUTHORIZED_ERROR)
 
 @app.route("/test", methods=['GET'])
@@ -75,16 +305,54 @@ def json_test():
         })
 
 
+def cached_body(key, variant, build, if_none_match):
+    ''' Returns (etag, body) of a resource of the response_cache, `build()` encodes it if it is not cached
+
+    The body is None if the If-None-Match header says the client already has it '''
+    etag = response_cache.etag(key, variant)
+    if etag_matches(if_none_match, etag):
+        return etag, None
+    return etag, response_cache.get(key, variant, build)
+
+def cached_response(key, variant, build):
+    ''' A JSON response (or a 304) for a resource of the response_cache '''
+    etag, body = cached_body(key, variant, build, request.headers.get('If-None-Match'))
+    if body is None:
+        return Response(status=304, headers={'ETag': etag})
+    return Response(body, mimetype='application/json', headers={'ETag': etag})
+
+def wire_format():
+    ''' The (format, content coding) of the messages for this request, see formats.py '''
+    return formats.negotiate(request.accept_mimetypes, request.accept_encodings)
+
+def cached_encoded_body(key, variant, build, wire, if_none_match):
+    ''' Same as cached_body for a body in a negotiated format, `build(fmt)` encodes it uncompressed
+
+    Returns (etag, (body, content coding)), the compressed body is what gets cached '''
+    fmt, coding = wire
+    return cached_body(key, f'{variant}:{fmt}:{coding}', lambda: formats.compress(build(fmt), coding), if_none_match)
+
+def cached_encoded_response(key, variant, build, wire):
+    ''' A response (or a 304) for a resource of the response_cache in a negotiated format '''
+    etag, encoded = cached_encoded_body(key, variant, build, wire, request.headers.get('If-None-Match'))
+    if encoded is None:
+        return Response(status=304, headers=formats.response_headers(etag))
+    body, coding = encoded
+    return Response(body, mimetype=formats.MEDIA_TYPES[wire[0]], headers=formats.response_headers(etag, coding))
+
+
 ### Users ###
+# The logic of every route lives in a plain function (that returns what gets sent back as JSON
+# and aborts on errors) so it can be shared with the asyncio version of this server (asgi_server.py)
+def all_users():
+    return [{'user': user} for user in list(cached_users)]
+
 @app.route("/user/list")
 def list_users():
     ''' List all the existing users '''
-    users = [{'user': user} for user in cached_users]
-    return jsonify(users)
+    return cached_response(USERS_KEY, '', lambda: dumps(all_users()))
 
-@app.route("/user/create/<username>", methods=['POST'])
-def create_user(username):
-    ''' Creates the user received as a parameter in the URL '''
+def add_user(username):
     if username in cached_users:
         abort(ALREADY_EXISTS_ERROR) # Already Exists
     elif not db.create_user(username):
@@ -93,145 +361,438 @@ def create_user(username):
         # Created user, store it in the local cache
         cached_users.add(username)
         # Add the user to the welcome room
-        db.join_room(username, 'welcome')
-        cached_rooms['welcome'].add(username)
-        return jsonify({"username": username, "joined_rooms": ['welcome']})
+        with room_lock('welcome'):
+            if db.join_room(username, 'welcome'):
+                cached_rooms.add(username, 'welcome')
+        response_cache.bump(USERS_KEY, MEMBERSHIPS_KEY)
+        backend.publish('user_created', username=username)
+        backend.publish('joined', roomname='welcome', username=username)
+        return {"username": username, "joined_rooms": ['welcome']}
 
-@app.route("/user/delete/<username>")
-def delete_user(username):
-    ''' Deletes the username from the database '''
-    # TODO: Include some "protection" (like a "secret" code) in a URL param against trolls
-    # trying to delete each other's accounts
+@app.route("/user/create/<username>", methods=['POST'])
+def create_user(username):
+    ''' Creates the user received as a parameter in the URL '''
+    return jsonify(add_user(username))
+
+def remove_user(username):
     if username in cached_users:
+        # The user and all its memberships go away in the same transaction
         if not db.delete_user(username):
             abort(NOT_FOUND_ERROR)
         else:
-            # Remove from all the joined rooms
-            joined_rooms = db.get_joined_rooms(username)
-            for room in joined_rooms:
-                if room in cached_rooms:
-                    cached_rooms[room].remove(username)
-                db.leave_room(username, room)
-            # Remove user from the cache
-            cached_users.remove(username)
+            # Remove user from the caches
+            cached_users.discard(username)
+            cached_rooms.remove_user(username)
+            response_cache.bump(USERS_KEY, MEMBERSHIPS_KEY)
+            backend.publish('user_deleted', username=username)
+            return {'username': username}
     else:
         abort(NOT_FOUND_ERROR)
 
+@app.route("/user/delete/<username>")
+def delete_user(username):
+    ''' Deletes the username from the database '''
+    # TODO: Include some "protection" (like a "secret" code) in a URL param against trolls
+    # trying to delete each other's accounts
+    return jsonify(remove_user(username))
+
 ### Joined Rooms ###
-@app.route("/joined_room/join/<roomname>")
-def join_room(roomname):
-    ''' Join the room '''
-    # Make sure the user exists
-    username = None
-    if 'username' not in request.args:
+def username_arg(args):
+    ''' The `username` query param, it must be an existing user '''
+    if 'username' not in args:
         abort(UNPROCESSABLE_ENTITY_ERROR) # TODO: which one was the one that returned 404?
-    else:
-        username = request.args.get('username')
-        if username not in cached_users:
-            abort(NOT_FOUND_ERROR)
-    # Now check the room
+    username = args.get('username')
+    if username not in cached_users:
+        abort(NOT_FOUND_ERROR)
+    return username
+
+def add_to_room(username, roomname):
     if roomname not in cached_rooms:
         abort(NOT_FOUND_ERROR)
     else:
-        success = db.join_room(username, roomname)
+        # The index changes under the same lock as the DB, so they never disagree
+        with room_lock(roomname):
+            success = db.join_room(username, roomname)
+            if success:
+                cached_rooms.add(username, roomname)
         if not success:
             abort(INTERNAL_SERVER_ERROR)
         else:
             # All well! Return all joined rooms from this user
-            cached_rooms[roomname].add(username)
-            rooms = db.get_joined_rooms(username)
-            return jsonify({ 'user': username, 'rooms': rooms })
+            response_cache.bump(MEMBERSHIPS_KEY)
+            backend.publish('joined', roomname=roomname, username=username)
+            return { 'user': username, 'rooms': cached_rooms.rooms_of(username) }
 
-@app.route("/joined_room/list/<username>")
-def list_joined_rooms(username):
+@app.route("/joined_room/join/<roomname>")
+def join_room(roomname):
     ''' Join the room '''
+    return jsonify(add_to_room(username_arg(request.args), roomname))
+
+def user_rooms(username):
     # Make sure the user exists
     if username not in cached_users:
         abort(NOT_FOUND_ERROR)
     else:
-        rooms = db.get_joined_rooms(username)
-        return jsonify({ 'user': username, 'rooms': rooms })
+        return { 'user': username, 'rooms': cached_rooms.rooms_of(username) }
 
-@app.route("/joined_room/leave/<roomname>")
-def leave_room(roomname):
-    # Make sure the user exists
-    username = None
-    if 'username' not in request.args:
-        abort(UNPROCESSABLE_ENTITY_ERROR) # TODO: which one was the one that returned 404?
-    else:
-        username = request.args.get('username')
-        if username not in cached_users:
-            abort(NOT_FOUND_ERROR)
-    # Now check the room
+@app.route("/joined_room/list/<username>")
+def list_joined_rooms(username):
+    ''' List the rooms the user has joined '''
+    return jsonify(user_rooms(username))
+
+def remove_from_room(username, roomname):
     if roomname not in cached_rooms:
         abort(NOT_FOUND_ERROR)
     elif username not in cached_rooms[roomname]:
         abort(NOT_FOUND_ERROR) # FIXME: Not the best error code, at all!
     else:
-        success = db.leave_room(username, roomname)
+        with room_lock(roomname):
+            success = db.leave_room(username, roomname)
+            if success:
+                cached_rooms.remove(username, roomname)
         if not success:
             abort(INTERNAL_SERVER_ERROR)
         else:
             # All well! Return all joined rooms from this user
-            cached_rooms[roomname].remove(username)
-            rooms = db.get_joined_rooms(username)
-            return jsonify({ 'user': username, 'rooms': rooms })
+            response_cache.bump(MEMBERSHIPS_KEY)
+            backend.publish('left', roomname=roomname, username=username)
+            return { 'user': username, 'rooms': cached_rooms.rooms_of(username) }
+
+@app.route("/joined_room/leave/<roomname>")
+def leave_room(roomname):
+    return jsonify(remove_from_room(username_arg(request.args), roomname))
+
+def all_memberships():
+    return [{room: list(users)} for room, users in cached_rooms.items()]
 
 @app.route("/joined_room/all")
 def list_all_rooms():
-    rooms = [{room: list(users)} for room, users in cached_rooms.items()]
-    return jsonify(rooms)
+    return cached_response(MEMBERSHIPS_KEY, '', lambda: dumps(all_memberships()))
 
 ### Rooms ###
+def all_rooms():
+    return [{'room': room} for room in list(cached_rooms)]
+
 @app.route("/room/list")
 def list_rooms():
     ''' List all the existing rooms '''
-    rooms = [{'room': room} for room in cached_rooms]
-    return jsonify(rooms)
+    return cached_response(ROOMS_KEY, '', lambda: dumps(all_rooms()))
 
-@app.route("/room/create/<roomname>", methods=['POST'])
-def create_room(roomname,):
-    ''' Creates the room received as a parameter in the URL '''
+def add_room(roomname):
     if roomname in cached_rooms:
         abort(ALREADY_EXISTS_ERROR) # Already Exists
     elif not db.create_room(roomname):
         abort(ALREADY_EXISTS_ERROR) # Probably bad, 'cause other error could occur, whatever...
     else:
-        cached_rooms.add(roomname)  # Crated user, store it in the local cache
-        return jsonify({'room': roomname})
+        # -1 unless a message sent to a room with this name was written after it was deleted
+        last_offset = db.get_last_offset(roomname)
+        with room_lock(roomname):
+            cached_rooms.add_room(roomname)  # Created room, store it in the local cache
+            room_offsets[roomname] = last_offset
+            allocated_offsets[roomname] = last_offset
+        response_cache.bump(ROOMS_KEY, MEMBERSHIPS_KEY, messages_key(roomname))
+        backend.publish('room_created', roomname=roomname)
+        return {'room': roomname}
 
-@app.route("/room/delete/<roomname>")
-def delete_room(roomname):
-    ''' Deletes the room from the database '''
+@app.route("/room/create/<roomname>", methods=['POST'])
+def create_room(roomname,):
+    ''' Creates the room received as a parameter in the URL '''
+    return jsonify(add_room(roomname))
+
+def forget_room(roomname):
+    ''' Removes the room from all the caches '''
+    with room_lock(roomname):
+        cached_rooms.remove_room(roomname)
+        room_offsets.pop(roomname, None)
+        allocated_offsets.pop(roomname, None)
+        cached_messages.forget(roomname)
+    response_cache.bump(ROOMS_KEY, MEMBERSHIPS_KEY, messages_key(roomname))
+
+def remove_room(roomname):
     # TODO: Some logic to make sure the room is safe to delete?
     if roomname in cached_rooms:
         if not db.delete_room(roomname):
             abort(NOT_FOUND_ERROR)
         else:
-            cached_rooms.remove(roomname)
+            forget_room(roomname)
+            backend.publish('room_deleted', roomname=roomname)
+            return {'room': roomname}
     else:
         abort(NOT_FOUND_ERROR)
 
+@app.route("/room/delete/<roomname>")
+def delete_room(roomname):
+    ''' Deletes the room from the database '''
+    return jsonify(remove_room(roomname))
+
+def room_retention(roomname):
+    ''' The retention policy of the room (the default one if it has none) '''
+    if roomname not in cached_rooms:
+        abort(NOT_FOUND_ERROR)
+    max_age, max_count = db.get_retention_policies().get(roomname, (RETENTION_MAX_AGE, RETENTION_MAX_COUNT))
+    return {'room': roomname, 'max_age': max_age, 'max_count': max_count}
+
+def set_room_retention(roomname, policy):
+    if roomname not in cached_rooms:
+        abort(NOT_FOUND_ERROR)
+    if not isinstance(policy, dict):
+        abort(UNPROCESSABLE_ENTITY_ERROR)
+    max_age, max_count = policy.get('max_age'), policy.get('max_count')
+    if (max_age is not None and (type(max_age) not in (int, float) or not 0 < max_age <= MAX_RETENTION_AGE)) or \
+       (max_count is not None and (type(max_count) is not int or max_count < 1)):
+        abort(UNPROCESSABLE_ENTITY_ERROR)
+    if not db.set_retention_policy(roomname, max_age, max_count):
+        abort(INTERNAL_SERVER_ERROR)
+    return room_retention(roomname)
+
+@app.route("/room/retention/<roomname>", methods=['GET', 'POST'])
+def retention(roomname):
+    ''' Gets (GET) or sets (POST) the retention policy of the room
+
+    Body (POST): {"max_age": <seconds>, "max_count": <messages>}, null (or missing) is no limit.
+    The messages over the limits are moved to the archive, they can still be read with /message/get
+    '''
+    if request.method == 'POST':
+        return jsonify(set_room_retention(roomname, request.get_json(silent=True)))
+    return jsonify(room_retention(roomname))
+
 ### Messages ###
+def message_to_json(message):
+    ''' The JSON representation of a message sent to the clients '''
+    return {'offset': message.offset, 'username': message.username, 'content': message.content, 'timestamp': int(datetime.timestamp(message.timestamp)) }
+
+SQLITE_INTEGERS = range(-2 ** 63, 2 ** 63)  # The ints that fit in an SQLite INTEGER
+
+def int_arg(args, name, default=None, lowest=None):
+    ''' An integer query param (the default if it is missing or not an int), it must fit in an SQLite INTEGER
+
+    Values lower than `lowest` are taken as `lowest` '''
+    value = args.get(name, default, type=int)
+    if value is not None and lowest is not None:
+        value = max(value, lowest)
+    if value is not None and value not in SQLITE_INTEGERS:
+        abort(UNPROCESSABLE_ENTITY_ERROR)
+    return value
+
+def get_messages_args(roomname, args):
+    ''' Validates the room and the query params of /message/get, returns (since, limit, wait) '''
+    if roomname not in cached_rooms:
+        abort(NOT_FOUND_ERROR)
+    since = int_arg(args, 'since', -1, lowest=-1)  # Every offset is >= 0, so anything lower means all of them
+    limit = int_arg(args, 'limit')
+    wait = args.get('wait', 0, type=float)
+    if (limit is not None and limit < 0) or not math.isfinite(wait) or wait < 0:
+        abort(UNPROCESSABLE_ENTITY_ERROR)  # A NaN wait would get past min() and hold the request forever
+    return since, limit, min(wait, MAX_POLL_WAIT)
+
+def has_messages_after(roomname, since):
+    ''' True if the room has a stored message newer than `since` (or does not exist anymore) '''
+    return room_offsets.get(roomname, since + 1) > since
+
+ROOM_MESSAGES_JSON = b'{"roomname":%s,"last_offset":%d,"messages":[%s]}'
+ROOM_COLUMNS_JSON = b'{"roomname":%s,"last_offset":%d,%s}'  # The messages by columns, see formats.py
+
+def messages_body(roomname, since=-1, limit=None, fmt=formats.JSON):
+    ''' The encoded answer of /message/get '''
+    # Read before the messages: a client using it as `since` may get a message twice but never miss one
+    last_offset = room_offsets.get(roomname, -1)
+    if fmt == formats.JSON:
+        messages = cached_messages.get_encoded(roomname, since, limit)
+        return ROOM_MESSAGES_JSON % (dumps(roomname), last_offset, messages)
+    columns = cached_messages.get_columns(roomname, since, limit)
+    return formats.from_columns(ROOM_COLUMNS_JSON % (dumps(roomname), last_offset, columns), fmt)
+
+def json_body(body):
+    ''' The JSON body of a request (None if it has none), it must be an object '''
+    if body is None:
+        return {}
+    if not isinstance(body, dict):
+        abort(UNPROCESSABLE_ENTITY_ERROR)
+    return body
+
+def get_many_args(body, args):
+    ''' Validates the body and the query params of /message/get_many, returns ({room: since}, limit) '''
+    rooms = body.get('rooms', {})
+    limit = int_arg(args, 'limit')
+    if not isinstance(rooms, dict) or \
+       any(type(since) is not int or max(since, -1) not in SQLITE_INTEGERS for since in rooms.values()) or \
+       (limit is not None and limit < 0):
+        abort(UNPROCESSABLE_ENTITY_ERROR)
+    rooms = {room: max(since, -1) for room, since in rooms.items()}  # Same as `since` in /message/get
+    username = args.get('username')
+    if username is not None:
+        if username not in cached_users:
+            abort(NOT_FOUND_ERROR)
+        joined = cached_rooms.rooms_of(username)
+        if any(room not in joined for room in rooms):
+            abort(UNAUTHORIZED_ERROR)
+        rooms = {room: rooms.get(room, -1) for room in joined}
+    elif any(room not in cached_rooms for room in rooms):
+        abort(NOT_FOUND_ERROR)
+    return rooms, limit
+
+def many_messages_body(rooms, limit=None, fmt=formats.JSON):
+    ''' The encoded answer of /message/get_many '''
+    last_offsets = {room: room_offsets.get(room, -1) for room in rooms}
+    messages = cached_messages.get_encoded_many(rooms, limit, columns=fmt != formats.JSON)
+    room_json = ROOM_MESSAGES_JSON if fmt == formats.JSON else ROOM_COLUMNS_JSON
+    body = b'{"rooms":[%s]}' % b','.join(room_json % (dumps(room), last_offsets[room], messages[room])
+                                         for room in rooms)
+    return body if fmt == formats.JSON else formats.from_columns(body, fmt)
+
+def many_messages_payload(rooms, limit, wire):
+    ''' The answer of /message/get_many in a negotiated format, as (body, content coding) '''
+    fmt, coding = wire
+    return formats.compress(many_messages_body(rooms, limit, fmt), coding)
+
+def messages_variant(since, limit):
+    return f'{since}:{limit}'
+
 @app.route("/message/get/<roomname>")
 def get_messages(roomname):
-    ''' Gets all the messages from a room '''
-    # FIXME: Migrate all of this to WebSocket so we can push to the client directly?
-    if roomname not in cached_rooms or roomname not in cached_messages:
+    ''' Gets the messages from a room
+
+    Query params:
+     since: only return the messages with an offset higher than this one (default: all)
+     limit: maximum number of messages to return (default: no limit)
+     wait: if there are no messages newer than `since`, hold the request up to this
+           many seconds until one arrives (long-polling, default: answer right away)
+
+    The format (JSON, JSON by columns or MessagePack) and the compression of the answer
+    are negotiated with the Accept and Accept-Encoding headers, see formats.py
+    '''
+    # NOTE: Clients that want the new messages pushed to them should use /message/stream instead
+    since, limit, wait = get_messages_args(roomname, request.args)
+    if wait and not has_messages_after(roomname, since):
+        broker.wait(roomname, lambda: has_messages_after(roomname, since), wait)
+    return cached_encoded_response(messages_key(roomname), messages_variant(since, limit),
+                                   lambda fmt: messages_body(roomname, since, limit, fmt), wire_format())
+
+@app.route("/message/get_many", methods=['POST'])
+def get_many_messages():
+    ''' Gets the messages from many rooms in one request
+
+    Body: {"rooms": {<roomname>: <since>, ...}}, same `since` as in /message/get
+
+    Query params:
+     username: get every room the user has joined (the ones not in the body from the start)
+     limit: maximum number of messages to return per room (default: no limit)
+
+    Answers {"rooms": [...]} with an item per room like the answer of /message/get (in the same formats)
+    '''
+    rooms, limit = get_many_args(json_body(request.get_json(silent=True)), request.args)
+    wire = wire_format()
+    body, coding = many_messages_payload(rooms, limit, wire)
+    return Response(body, mimetype=formats.MEDIA_TYPES[wire[0]], headers=formats.response_headers(coding=coding))
+
+def search_args(args):
+    ''' Validates the query params of /message/search, returns the kwargs of db.search_messages '''
+    text = args.get('q', '')
+    room = args.get('room')
+    since = args.get('since', None, type=float)
+    until = args.get('until', None, type=float)
+    limit = args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    if not text.strip() or not 0 < limit <= SEARCH_MAX_PAGE_SIZE:
+        abort(UNPROCESSABLE_ENTITY_ERROR)
+    if room is not None and room not in cached_rooms:
         abort(NOT_FOUND_ERROR)
-    else:
-        messages = cached_messages[roomname]  # TODO: Think about how we refresh this cache... it should be kept in sync by us manually, no need to call back to the db
-        json_messages = [{'offset': message.offset, 'username': message.username, 'content': message.content, 'timestamp': int(datetime.timestamp(message.timestamp)) } for message in messages]
-        return jsonify({ 'roomname': roomname, 'messages': json_messages})
+    try:
+        since = None if since is None else datetime.fromtimestamp(since)
+        until = None if until is None else datetime.fromtimestamp(until)
+    except (OverflowError, OSError, ValueError):  # Out of range (or NaN)
+        abort(UNPROCESSABLE_ENTITY_ERROR)
+    return {'text': text, 'room': room, 'username': args.get('username'), 'since': since, 'until': until,
+            'before': int_arg(args, 'cursor'), 'limit': limit}
 
-@app.route("/message/send/<roomname>", methods=['GET', 'POST'])
-def send_message(roomname):
-    ''' Send a message '''
-    message = request.json["message"]
-    if "username" not in message and \
-       "roomname" not in message and \
-       "content" not in message and \
-       "timestamp" not in message:
+def search_messages(kwargs):
+    messages, cursor = db.search_messages(**kwargs)
+    # The messages of a room deleted since the search ran are not shown
+    return {'messages': [dict(message_to_json(message), roomname=message.roomname)
+                         for message in messages if message.roomname in cached_rooms],
+            'cursor': cursor}
+
+@app.route("/message/search")
+def search():
+    ''' Full text search of the messages, newest first
+
+    Query params:
+     q: the words to search, all of them must be in the message (`word*` matches any word starting with it)
+     room, username: only the messages of this room / from this user
+     since, until: only the messages sent in [since, until) (timestamps as sent in the messages)
+     limit: maximum number of results (default: SEARCH_PAGE_SIZE)
+     cursor: to get the next page, the `cursor` returned with the previous one (null on the last page)
+    '''
+    return jsonify(search_messages(search_args(request.args)))
+
+def stream_rooms_arg(args):
+    ''' The rooms to subscribe to in /message/stream, they must exist '''
+    rooms = [room for room in args.get('rooms', '').split(',') if room]
+    if not rooms:
+        abort(UNPROCESSABLE_ENTITY_ERROR)
+    if any(room not in cached_rooms for room in rooms):
+        abort(NOT_FOUND_ERROR)
+    return rooms
+
+STREAM_START = 'retry: 3000\n\n'
+STREAM_KEEPALIVE_EVENT = ': keepalive\n\n'
+STREAM_DISCONNECT_EVENT = 'event: disconnect\ndata: slow consumer\n\n'
+
+def message_event(message):
+    ''' The Server-Sent Event for a message '''
+    data = json.dumps(dict(message_to_json(message), roomname=message.roomname))
+    return f'id: {message.roomname}:{message.offset}\nevent: message\ndata: {data}\n\n'
+
+@app.route("/message/stream")
+def stream_messages():
+    ''' Pushes the new messages of some rooms as Server-Sent Events
+
+    Query params:
+     rooms: comma separated list of rooms to subscribe to
+
+    Every event carries `<roomname>:<offset>` as its id. If the client is too slow
+    reading the stream it gets a `disconnect` event and the stream is closed, it should
+    then catch up with /message/get/<roomname>?since=<offset> and subscribe again
+    '''
+    subscriber = broker.subscribe(stream_rooms_arg(request.args))
+
+    def events():
+        try:
+            # Send something right away so the headers are flushed to the client
+            yield STREAM_START
+            while not subscriber.closed:
+                message = subscriber.get(timeout=STREAM_KEEPALIVE)
+                if subscriber.closed:
+                    break
+                if message is None:
+                    yield STREAM_KEEPALIVE_EVENT
+                    continue
+                yield message_event(message)
+            yield STREAM_DISCONNECT_EVENT
+        finally:
+            broker.unsubscribe(subscriber)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def message_stored(message):
+    ''' Called from the DB writer thread, in offset order, once a message is committed '''
+    with room_lock(message.roomname):
+        if message.roomname not in room_offsets:
+            return  # The room was deleted
+        cached_messages.append(message)
+        room_offsets[message.roomname] = max(room_offsets[message.roomname], message.offset)
+    response_cache.bump(messages_key(message.roomname))
+    broker.publish(message)
+
+def parse_message(message):
+    ''' Validates the message (a dict as received from the client), returns it as a Message without offset '''
+    if not isinstance(message, dict) or \
+       "username" not in message or \
+       "roomname" not in message or \
+       "content" not in message or \
+       "timestamp" not in message or \
+       any(type(message[field]) is not str for field in ("username", "roomname", "content")) or \
+       type(message["timestamp"]) not in (int, float):
            abort(UNPROCESSABLE_ENTITY_ERROR)
     elif message["roomname"] not in cached_rooms or \
          message["username"] not in cached_users:
@@ -239,22 +800,142 @@ def send_message(roomname):
     elif message["username"] not in cached_rooms[message["roomname"]]:
         abort(UNAUTHORIZED_ERROR)
     else:
-        # Well formed message, send it!
-        timestamp = datetime.fromtimestamp(message["timestamp"])
-        this_offset = room_offsets[message["roomname"]] + 1
-        sent_message = Message(offset=this_offset, roomname=message["roomname"],
-                               username=message["username"], content=message["content"],
-                               timestamp=timestamp)
-        print(f'Trying to send message {message} and the offset is {room_offsets[message["roomname"]]}')
-        if not db.send_message(sent_message):
-            abort(INTERNAL_SERVER_ERROR)
-        else:
-            # Successfully saved the message to the db
-            room_offsets[message["roomname"]] = this_offset
-            cached_messages[message["roomname"]].append(sent_message)
+        try:
+            timestamp = datetime.fromtimestamp(message["timestamp"])
+            message["content"].encode('utf-8')  # Lone surrogates are valid JSON but cannot be stored
+        except (OverflowError, OSError, ValueError):  # Out of range (or NaN), or not UTF-8
+            abort(UNPROCESSABLE_ENTITY_ERROR)
+        # Well formed message
+        return Message(offset=None, roomname=message["roomname"],
+                       username=message["username"], content=message["content"],
+                       timestamp=timestamp)
+
+def too_many_requests(retry_after):
+    ''' Aborts with a 429, telling the client to retry after `retry_after` seconds '''
+    raise TooManyRequests(retry_after=max(1, math.ceil(retry_after)))
+
+def admit_messages(messages):
+    ''' Rejects the messages (429) when the DB writer is too far behind or when a user or
+    a room is over its rate limit, so an overload is answered right away instead of timing out '''
+    if MAX_WRITE_BACKLOG is not None and db.writer_backlog() >= MAX_WRITE_BACKLOG:
+        SENDS_REJECTED.inc(reason='backlog')
+        too_many_requests(BACKLOG_RETRY_AFTER)
+    costs = Counter()
+    for message in messages:
+        costs['user', message.username] += 1
+        costs['room', message.roomname] += 1
+    kind, retry_after = send_limiter.acquire(costs)
+    if kind is not None:
+        SENDS_REJECTED.inc(reason=kind)
+        too_many_requests(retry_after)
+
+def queue_messages(messages):
+    ''' Validates the messages (dicts as received from the client) and enqueues them to be stored
+    in a single transaction, none of them is sent if any is not valid
 
-    return jsonify({'status': 200}) # What to send back here?
-# TODO: Think about a function that returns the *NEW* messages (maybe using the offset variable, since it is a autoincrementing INTEGER?)
+    Returns a PendingWrite of the DB per message '''
+    if not isinstance(messages, list) or not messages:
+        abort(UNPROCESSABLE_ENTITY_ERROR)
+    parsed = [parse_message(message) for message in messages]
+    admit_messages(parsed)
+    if backend.shared:
+        # The offsets are handed out by the DB writer and the messages reach the cache through the backend feed
+        return db.submit_messages(parsed, on_stored=backend.notify)
+    roomnames = {message.roomname for message in parsed}
+    with rooms_lock(roomnames):
+        if any(roomname not in allocated_offsets for roomname in roomnames):
+            abort(NOT_FOUND_ERROR)  # Deleted while we were checking it
+        # Handing out the offsets and enqueueing the write under the room locks keeps the
+        # messages of every room in offset order all the way to the DB
+        sent_messages = []
+        for message in parsed:
+            this_offset = allocated_offsets[message.roomname] + 1
+            allocated_offsets[message.roomname] = this_offset
+            sent_messages.append(message._replace(offset=this_offset))
+            log.debug('Trying to send message %s and the offset is %s', message, this_offset)
+        return db.submit_messages(sent_messages, on_stored=message_stored)
+
+def queue_message(message):
+    ''' Validates the message (a dict as received from the client) and enqueues it to be stored
+
+    Returns the PendingWrite of the DB '''
+    return queue_messages([message])[0]
+
+def message_sent(pending):
+    ''' The answer to the client once the message is sent '''
+    if pending.ok is False:
+        abort(INTERNAL_SERVER_ERROR)
+    return {'status': 200, 'offset': pending.message.offset} # The offset lets the client ask only for newer messages
+
+def wait_stored(pendings):
+    ''' Waits (up to SEND_TIMEOUT) until the messages are committed, aborts with a 503 if they are not
+    by then (they may still be stored later) '''
+    deadline = time.monotonic() + SEND_TIMEOUT
+    for pending in pendings:
+        if pending.wait(max(deadline - time.monotonic(), 0)) is None:
+            abort(SERVICE_UNAVAILABLE_ERROR)
+
+def store_message(message, durable=SEND_DURABLE):
+    ''' Sends the message (a dict as received from the client) '''
+    pending = queue_message(message)
+    if durable:
+        wait_stored([pending])
+    return message_sent(pending)
+
+def many_sent(pendings):
+    ''' The answer to the client once the messages of /message/send_many are sent '''
+    if any(pending.ok is False for pending in pendings):
+        abort(INTERNAL_SERVER_ERROR)
+    return {'status': 200, 'offsets': [pending.message.offset for pending in pendings]}
+
+def store_messages(messages, durable=SEND_DURABLE):
+    ''' Sends the messages (a list of dicts as received from the client) '''
+    pendings = queue_messages(messages)
+    if durable:
+        wait_stored(pendings)
+    return many_sent(pendings)
+
+def durable_arg(args):
+    return args.get('durable', '1' if SEND_DURABLE else '0') != '0'
+
+@app.route("/message/send/<roomname>", methods=['GET', 'POST'])
+def send_message(roomname):
+    ''' Send a message
+
+    Query params:
+     durable: 0 to get the answer as soon as the message is enqueued for writing instead of
+              waiting for it to be committed to the DB (default: SEND_DURABLE)
+    '''
+    body = json_body(request.get_json(silent=True))
+    return jsonify(store_message(body.get("message"), durable_arg(request.args)))
+
+@app.route("/message/send_many", methods=['POST'])
+def send_many_messages():
+    ''' Send many messages (to any rooms) in one request, they are stored in a single transaction
+
+    Body: {"messages": [<message>, ...]}, the same messages as in /message/send
+
+    Query params:
+     durable: same as in /message/send
+
+    Answers with the offsets of the messages, in the same order
+    '''
+    body = json_body(request.get_json(silent=True))
+    return jsonify(store_messages(body.get("messages"), durable_arg(request.args)))
+
+### Cache ###
+def all_cache_stats():
+    return dict(cached_messages.stats(), responses=response_cache.stats())
+
+@app.route("/cache/stats")
+def cache_stats():
+    ''' Size and hit/miss counters of the messages and responses caches '''
+    return jsonify(all_cache_stats())
+
+@app.route("/db/stats")
+def db_stats():
+    ''' Connection pool and message writer metrics '''
+    return jsonify(db.stats())
 
 
 ### Error Handlers ###
@@ -270,18 +951,27 @@ def error_already_exists(error):
 def error_already_exists(error):
     return make_response(jsonify({'code': error.code, 'description': error.description}), INTERNAL_SERVER_ERROR)
 
+@app.errorhandler(SERVICE_UNAVAILABLE_ERROR)
+def error_service_unavailable(error):
+    return make_response(jsonify({'code': error.code, 'description': error.description}), SERVICE_UNAVAILABLE_ERROR)
+
 @app.errorhandler(UNAUTHORIZED_ERROR)
 def error_unauthorized(error):
     return make_response(jsonify({'code': error.code, 'description': error.description}), UNAUTHORIZED_ERROR)
 
+@app.errorhandler(TOO_MANY_REQUESTS_ERROR)
+def error_too_many_requests(error):
+    return make_response(jsonify({'code': error.code, 'description': error.description}), TOO_MANY_REQUESTS_ERROR,
+                         {'Retry-After': str(error.retry_after)})
+
 ### Init ###
 def init_server():
     ''' This initializes the server to bootstrap the DB and some basic data '''
     pass
 
 if __name__ == '__main__':
-    print("Initializing the cache...")
+    log.info("Initializing the cache...")
     if not init_cache():
-        print('ERROR INITIALIZING CACHE...')
+        log.error('ERROR INITIALIZING CACHE...')
         exit(1)
     app.run(debug=True)
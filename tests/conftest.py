@@ -0,0 +1,65 @@
+'''
+The server is imported once per test session, on a fresh DB in a temporary directory
+(server.py opens the DB in db/ relative to the working directory when it is imported)
+'''
+import itertools
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+_names = itertools.count()
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('zero-chat')
+    os.makedirs(workdir / 'db')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import server
+        from ratelimit import RateLimiter
+        assert server.init_cache()
+        server.send_limiter = RateLimiter()  # The tests send faster than any real user
+        yield server
+        server.archiver.stop()
+        if server.db.writer_backlog() == 0:
+            server.db.close()
+        # Otherwise the writer is stuck (a test failed with a deadlock), its daemon thread dies with pytest
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+def unique(prefix):
+    ''' A name no other test uses, so the tests do not need a DB of their own '''
+    return f'{prefix}_{next(_names)}'
+
+
+@pytest.fixture
+def make_room(client):
+    ''' Creates a room joined by `users` new users, returns (roomname, usernames) '''
+    def make(users=1):
+        roomname = unique('room')
+        assert client.post(f'/room/create/{roomname}').status_code == 200
+        usernames = []
+        for _ in range(users):
+            username = unique('user')
+            assert client.post(f'/user/create/{username}').status_code == 200
+            assert client.get(f'/joined_room/join/{roomname}?username={username}').status_code == 200
+            usernames.append(username)
+        return roomname, usernames
+    return make
+
+
+def message(roomname, username, content='hello'):
+    return {'username': username, 'roomname': roomname, 'content': content, 'timestamp': time.time()}
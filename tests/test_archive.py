@@ -0,0 +1,86 @@
+'''
+Retention policies and the archive
+'''
+import os
+
+import pytest
+
+from archive import Archiver
+from conftest import message
+
+
+@pytest.fixture
+def send_many(client):
+    def send(roomname, username, count):
+        batch = [message(roomname, username, f'{i}') for i in range(count)]
+        assert client.post('/message/send_many', json={'messages': batch}).status_code == 200
+    return send
+
+
+@pytest.mark.parametrize('policy', [{'max_age': 1e300}, {'max_age': float('inf')}, {'max_age': 0},
+                                    {'max_age': -1}, {'max_age': True}, {'max_age': '1'}, {'max_count': 0}])
+def test_invalid_retention_policy(client, make_room, policy):
+    roomname, _ = make_room()
+    assert client.post(f'/room/retention/{roomname}', json=policy).status_code == 422
+
+
+def test_cutoff_of_a_huge_max_age(server, make_room, send_many):
+    roomname, (username,) = make_room()
+    send_many(roomname, username, 3)
+    assert server.db.get_archive_cutoff(roomname, max_age=1e300) is None
+
+
+def test_a_failing_room_does_not_stop_the_others(server, make_room, send_many, monkeypatch):
+    (bad, (bad_user,)), (good, (good_user,)) = make_room(), make_room()
+    send_many(bad, bad_user, 5)
+    send_many(good, good_user, 5)
+    assert server.db.set_retention_policy(bad, max_count=1)
+    assert server.db.set_retention_policy(good, max_count=1)
+    get_archive_cutoff = server.db.get_archive_cutoff
+
+    def failing(room, *args):
+        if room == bad:
+            raise OverflowError('date value out of range')
+        return get_archive_cutoff(room, *args)
+
+    monkeypatch.setattr(server.db, 'get_archive_cutoff', failing)
+    archiver = Archiver(server.db)
+    archiver.run_once()
+    assert [m.offset for m in server.db.get_room_tail(good, 10)] == [4]
+    assert len(server.db.get_room_tail(bad, 10)) == 5
+
+
+def test_segment_written_without_the_write_lock(server, make_room, send_many, monkeypatch):
+    roomname, (username,) = make_room()
+    send_many(roomname, username, 10)
+    write = server.db.archive.write
+
+    def checked_write(room, rows):
+        assert not server.db.pool._writer_lock.locked()
+        return write(room, rows)
+
+    monkeypatch.setattr(server.db.archive, 'write', checked_write)
+    assert server.db.archive_messages(roomname, upto=5) == 6
+    assert [m.content for m in server.db.get_room_messages(roomname)] == [str(i) for i in range(10)]
+
+
+def test_range_archived_by_someone_else_meanwhile(server, make_room, send_many, monkeypatch):
+    roomname, (username,) = make_room()
+    send_many(roomname, username, 10)
+    write = server.db.archive.write
+    paths = []
+
+    def racing_write(room, rows):
+        path = write(room, rows)
+        paths.append(path)
+        if len(paths) == 1:
+            # Another archiver takes the same range between our read and our transaction
+            assert server.db.archive_messages(roomname, upto=5) == 6
+        return path
+
+    monkeypatch.setattr(server.db.archive, 'write', racing_write)
+    assert server.db.archive_messages(roomname, upto=5) == 0
+    assert paths[0] == paths[1]
+    assert os.path.exists(os.path.join(server.db.archive.directory, paths[0]))  # Kept, the other one indexed it
+    assert server.db.get_archive_stats()['archived_messages'] >= 6
+    assert [m.content for m in server.db.get_room_messages(roomname)] == [str(i) for i in range(10)]
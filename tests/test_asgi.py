@@ -0,0 +1,43 @@
+'''
+The asyncio version of the server (asgi_server.py), on the same state as server.py
+'''
+import asyncio
+import threading
+
+import pytest
+
+from conftest import message
+
+pytest.importorskip('quart')
+
+
+@pytest.fixture
+def asgi_app(server):
+    import asgi_server
+    return asgi_server.app
+
+
+def test_send_does_not_block_the_event_loop(server, asgi_app, make_room):
+    # A join holds the room lock across a DB write, a send waiting for it must not stall other requests
+    roomname, (username,) = make_room()
+
+    async def run():
+        client = asgi_app.test_client()
+        lock = server.room_lock(roomname)
+        lock.acquire()
+        release = threading.Timer(2, lock.release)
+        release.start()
+        send = asyncio.ensure_future(client.post(f'/message/send/{roomname}',
+                                                 json={'message': message(roomname, username)}))
+        await asyncio.sleep(0.1)
+        assert not send.done()
+        for path in ('/', '/db/stats', '/cache/stats'):
+            response = await client.get(path)
+            assert response.status_code == 200
+        assert lock.locked()  # Answered while the send was still waiting for the lock
+        response = await asyncio.wait_for(send, 5)
+        assert response.status_code == 200
+        assert (await response.get_json())['offset'] == 0
+        release.join()
+
+    asyncio.run(run())
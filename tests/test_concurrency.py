@@ -0,0 +1,132 @@
+'''
+Concurrent requests against the server: the room locks, the offsets and the DB writer
+'''
+import threading
+import time
+
+from conftest import message, unique
+
+TIMEOUT = 30  # Seconds before a test that should take well under one is taken for a deadlock
+
+
+def run_threads(*targets):
+    ''' Runs every target in its own thread, fails if any of them does not finish in time '''
+    errors = []
+
+    def run(target):
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(target,), daemon=True) for target in targets]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + TIMEOUT
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+    assert not any(thread.is_alive() for thread in threads), 'deadlock: some threads did not finish'
+    if errors:
+        raise errors[0]
+
+
+def test_send_while_joining_and_leaving_the_same_room(server, make_room):
+    # The DB writer thread takes the room lock once a message is stored, and joining takes
+    # the DB write lock while holding the room lock: they must never wait for each other
+    roomname, (sender,) = make_room()
+    visitor = unique('user')
+    assert server.app.test_client().post(f'/user/create/{visitor}').status_code == 200
+    statuses = []
+
+    def send():
+        client = server.app.test_client()
+        for i in range(100):
+            response = client.post(f'/message/send/{roomname}', json={'message': message(roomname, sender, f'{i}')})
+            statuses.append(response.status_code)
+
+    def join_and_leave():
+        client = server.app.test_client()
+        for _ in range(50):
+            statuses.append(client.get(f'/joined_room/join/{roomname}?username={visitor}').status_code)
+            statuses.append(client.get(f'/joined_room/leave/{roomname}?username={visitor}').status_code)
+
+    run_threads(send, send, join_and_leave)
+    assert set(statuses) == {200}
+    assert server.db.get_joined_users(roomname) == [sender]
+    assert visitor not in server.cached_rooms[roomname]
+
+
+def test_concurrent_sends_get_unique_gapless_offsets(server, make_room):
+    (roomname, usernames), (other, other_users) = make_room(users=4), make_room(users=2)
+    offsets = {roomname: [], other: []}
+    lock = threading.Lock()
+
+    def send(username):
+        def run():
+            client = server.app.test_client()
+            for i in range(50):
+                response = client.post(f'/message/send/{roomname}',
+                                       json={'message': message(roomname, username, f'{username} {i}')})
+                assert response.status_code == 200
+                with lock:
+                    offsets[roomname].append(response.get_json()['offset'])
+        return run
+
+    def send_many(username, other_username):
+        def run():
+            client = server.app.test_client()
+            for i in range(10):
+                # Two rooms in the same transaction, their room locks are taken together
+                batch = [message(roomname, username, f'{username} {i} {j}') for j in range(4)] + \
+                        [message(other, other_username, f'{other_username} {i}')]
+                response = client.post('/message/send_many', json={'messages': batch})
+                assert response.status_code == 200
+                sent = response.get_json()['offsets']
+                assert sent[:4] == list(range(sent[0], sent[0] + 4))  # Consecutive within a request
+                with lock:
+                    offsets[roomname].extend(sent[:4])
+                    offsets[other].append(sent[4])
+        return run
+
+    run_threads(*(send(username) for username in usernames[:2]),
+                *(send_many(username, other_username) for username, other_username in zip(usernames[2:], other_users)))
+
+    for room, count in ((roomname, 2 * 50 + 2 * 10 * 4), (other, 2 * 10)):
+        assert sorted(offsets[room]) == list(range(count))
+        assert [m.offset for m in server.db.get_room_messages(room)] == list(range(count))
+        assert server.room_offsets[room] == server.allocated_offsets[room] == count - 1
+        answer = server.app.test_client().get(f'/message/get/{room}').get_json()
+        assert [m['offset'] for m in answer['messages']] == list(range(count))
+        assert answer['last_offset'] == count - 1
+    # Every user's messages were stored in the order they were sent
+    for username in usernames:
+        mine = [m.content for m in server.db.get_room_messages(roomname) if m.username == username]
+        assert mine == sorted(mine, key=lambda content: [int(n) for n in content.split()[1:]])
+
+
+def test_polling_while_sending_never_misses_a_message(server, make_room):
+    # A client asking for the messages after the last offset it got must see every message, once and in order
+    roomname, (username,) = make_room()
+    total = 300
+    received = [[], []]
+
+    def send():
+        client = server.app.test_client()
+        for i in range(0, total, 3):
+            batch = [message(roomname, username, f'{i + j}') for j in range(3)]
+            assert client.post('/message/send_many?durable=0', json={'messages': batch}).status_code == 200
+
+    def poll(mine):
+        def run():
+            client = server.app.test_client()
+            since = -1
+            while since < total - 1:
+                answer = client.get(f'/message/get/{roomname}?since={since}&limit=7&wait=1').get_json()
+                mine.extend((m['offset'], m['content']) for m in answer['messages'])
+                if mine:
+                    since = mine[-1][0]
+        return run
+
+    run_threads(send, *map(poll, received))
+    for mine in received:
+        assert mine == [(offset, str(offset)) for offset in range(total)]
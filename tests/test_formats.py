@@ -0,0 +1,125 @@
+'''
+Negotiated wire formats, compression and ETags of the read endpoints
+'''
+import gzip
+import json
+
+import pytest
+
+import formats
+from conftest import message, unique
+
+COLUMNS = 'application/vnd.zero-chat.columns+json'
+
+
+@pytest.fixture
+def room(client, make_room):
+    ''' A room with a few short messages (a body under COMPRESS_MIN_SIZE) '''
+    roomname, (username,) = make_room()
+    batch = [message(roomname, username, f'message {i}') for i in range(3)]
+    assert client.post('/message/send_many', json={'messages': batch}).status_code == 200
+    return roomname
+
+
+@pytest.fixture
+def big_room(client, make_room):
+    ''' A room with a body well over COMPRESS_MIN_SIZE '''
+    roomname, (username,) = make_room()
+    batch = [message(roomname, username, f'message {i} ' + 'x' * 100) for i in range(50)]
+    assert client.post('/message/send_many', json={'messages': batch}).status_code == 200
+    return roomname
+
+
+def by_columns(answer):
+    ''' The messages of a JSON answer, by columns '''
+    return dict({'roomname': answer['roomname'], 'last_offset': answer['last_offset']},
+                **{column + 's': [m[column] for m in answer['messages']]
+                   for column in ('offset', 'username', 'content', 'timestamp')})
+
+
+def test_json_by_default(client, room):
+    response = client.get(f'/message/get/{room}')
+    assert response.mimetype == 'application/json'
+    assert response.headers['Vary'] == formats.VARY
+    assert [m['content'] for m in response.get_json()['messages']] == ['message 0', 'message 1', 'message 2']
+
+
+def test_columns(client, room):
+    answer = client.get(f'/message/get/{room}').get_json()
+    response = client.get(f'/message/get/{room}', headers={'Accept': COLUMNS})
+    assert response.mimetype == COLUMNS
+    assert json.loads(response.data) == by_columns(answer)
+    many = client.post('/message/get_many', json={'rooms': {room: 0}}, headers={'Accept': COLUMNS})
+    answer['messages'] = answer['messages'][1:]  # since=0
+    assert json.loads(many.data)['rooms'] == [by_columns(answer)]
+
+
+def test_preferred_format(client, room):
+    response = client.get(f'/message/get/{room}', headers={'Accept': f'application/json;q=0.5, {COLUMNS}'})
+    assert response.mimetype == COLUMNS
+    response = client.get(f'/message/get/{room}', headers={'Accept': 'text/html'})
+    assert response.mimetype == 'application/json'
+
+
+@pytest.mark.skipif(formats.msgpack is None, reason='msgpack is not installed')
+def test_msgpack(client, room):
+    answer = client.get(f'/message/get/{room}').get_json()
+    response = client.get(f'/message/get/{room}', headers={'Accept': 'application/msgpack'})
+    assert response.mimetype == 'application/msgpack'
+    assert formats.msgpack.unpackb(response.data) == by_columns(answer)
+
+
+@pytest.mark.skipif(formats.msgpack is not None, reason='msgpack is installed')
+def test_msgpack_not_installed(client, room):
+    response = client.get(f'/message/get/{room}', headers={'Accept': 'application/msgpack'})
+    assert response.mimetype == 'application/json'
+
+
+def test_gzip_only_big_bodies(client, room, big_room):
+    small = client.get(f'/message/get/{room}', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+    plain = client.get(f'/message/get/{big_room}')
+    assert len(plain.data) >= formats.COMPRESS_MIN_SIZE
+    assert 'Content-Encoding' not in plain.headers
+    compressed = client.get(f'/message/get/{big_room}', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['Vary'] == formats.VARY
+    assert len(compressed.data) < len(plain.data)
+    assert gzip.decompress(compressed.data) == plain.data
+    many = client.post('/message/get_many', json={'rooms': {big_room: -1}}, headers={'Accept-Encoding': 'gzip'})
+    assert many.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(many.data))['rooms'][0] == plain.get_json()
+
+
+def test_etag_per_format_and_coding(client, big_room):
+    variants = [{}, {'Accept-Encoding': 'gzip'}, {'Accept': COLUMNS}, {'Accept': COLUMNS, 'Accept-Encoding': 'gzip'}]
+    etags = [client.get(f'/message/get/{big_room}', headers=headers).headers['ETag'] for headers in variants]
+    assert len(set(etags)) == len(etags)
+    for headers, etag in zip(variants, etags):
+        response = client.get(f'/message/get/{big_room}', headers=dict(headers, **{'If-None-Match': etag}))
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.headers['ETag'] == etag
+        assert response.headers['Vary'] == formats.VARY
+    # The ETag of another coding does not match
+    response = client.get(f'/message/get/{big_room}', headers={'If-None-Match': etags[1]})
+    assert response.status_code == 200
+    # Nor once the room changed
+    username = client.get(f'/message/get/{big_room}').get_json()['messages'][0]['username']
+    assert client.post(f'/message/send/{big_room}', json={'message': message(big_room, username)}).status_code == 200
+    response = client.get(f'/message/get/{big_room}', headers={'If-None-Match': etags[0]})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etags[0]
+
+
+@pytest.mark.parametrize('path, create', [('/user/list', '/user/create/{}'), ('/room/list', '/room/create/{}')])
+def test_etag_of_the_lists(client, path, create):
+    first = client.get(path)
+    etag = first.headers['ETag']
+    assert client.get(path, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(path, headers={'If-None-Match': f'"other", {etag}'}).status_code == 304
+    assert client.post(create.format(unique('name'))).status_code == 200
+    second = client.get(path, headers={'If-None-Match': etag})
+    assert second.status_code == 200
+    assert second.headers['ETag'] != etag
+    assert len(second.get_json()) == len(first.get_json()) + 1
@@ -0,0 +1,118 @@
+'''
+Reading the messages of a room, from the cache, the DB and the archive
+'''
+from datetime import datetime
+
+import pytest
+
+from db import Message
+
+from conftest import message
+
+
+@pytest.fixture
+def archived_room(server, client, make_room):
+    ''' A room with 10 messages, the first 7 of them archived '''
+    roomname, (username,) = make_room()
+    for i in range(10):
+        response = client.post(f'/message/send/{roomname}', json={'message': message(roomname, username, f'{i}')})
+        assert response.status_code == 200
+    assert server.db.archive_messages(roomname, upto=6) == 7
+    return roomname
+
+
+@pytest.mark.parametrize('since, limit', [(-1, None), (-1, 0), (-1, 3), (-1, 7), (-1, 8), (3, 2), (3, 5), (6, 2), (9, 1)])
+def test_archived_messages_since_limit(server, archived_room, since, limit):
+    messages = server.db.get_room_messages_since(archived_room, since, limit)
+    expected = list(range(since + 1, 10))[:limit]
+    assert [m.offset for m in messages] == expected
+    assert [m.content for m in messages] == [str(offset) for offset in expected]
+
+
+def test_get_with_limit_zero(client, archived_room):
+    answer = client.get(f'/message/get/{archived_room}?limit=0').get_json()
+    assert answer['messages'] == []
+    assert answer['last_offset'] == 9
+
+
+@pytest.mark.parametrize('path', ['/message/get_many', '/message/send_many', '/message/send/welcome'])
+@pytest.mark.parametrize('body', [[1], 'text', 3])
+def test_body_not_an_object(client, path, body):
+    assert client.post(path, json=body).status_code == 422
+
+
+@pytest.mark.parametrize('field, value', [('timestamp', 'yesterday'), ('timestamp', None), ('timestamp', True),
+                                          ('timestamp', 1e300), ('roomname', ['a']), ('roomname', 1),
+                                          ('username', {}), ('content', 3), ('content', '\ud800')])
+def test_message_with_wrong_types(client, make_room, field, value):
+    roomname, (username,) = make_room()
+    bad = dict(message(roomname, username), **{field: value})
+    assert client.post(f'/message/send/{roomname}', json={'message': bad}).status_code == 422
+    assert client.post('/message/send_many', json={'messages': [message(roomname, username), bad]}).status_code == 422
+    assert client.get(f'/message/get/{roomname}').get_json()['messages'] == []
+
+
+def test_cache_and_db_agree(server, client, make_room, monkeypatch):
+    # More messages than the cache keeps of a room, so the oldest ones are read from the DB
+    monkeypatch.setattr(server.cached_messages, 'room_capacity', 50)
+    roomname, usernames = make_room(users=3)
+    for i in range(0, 120, 10):
+        batch = [message(roomname, usernames[j % 3], f'{i + j}') for j in range(10)]
+        assert client.post('/message/send_many', json={'messages': batch}).status_code == 200
+    server.cached_messages.forget(roomname)  # Cold, it is loaded from the DB on the first read
+
+    for since in (-1, 0, 30, 68, 69, 70, 71, 100, 118, 119, 200):
+        for limit in (None, 0, 1, 20, 50, 200):
+            expected = [server.message_to_json(m) for m in server.db.get_room_messages_since(roomname, since, limit)]
+            assert [m['offset'] for m in expected] == list(range(since + 1, 120))[:limit]
+            query = {'since': since} if limit is None else {'since': since, 'limit': limit}
+            answer = client.get(f'/message/get/{roomname}', query_string=query).get_json()
+            assert answer['messages'] == expected, (since, limit)
+            assert answer['last_offset'] == 119
+            del query['since']
+            many = client.post('/message/get_many', query_string=query, json={'rooms': {roomname: since}}).get_json()
+            assert many['rooms'][0]['messages'] == expected, (since, limit)
+    assert server.cached_messages.stats()['hits'] > 0
+
+
+def test_writer_survives_a_message_it_cannot_store(server, client, make_room):
+    roomname, (username,) = make_room()
+    # Past the validation of the routes: SQLite cannot encode a lone surrogate, which is not an sqlite3.Error
+    bad = Message(offset=0, roomname=roomname, username=username, content='\ud800', timestamp=datetime.now())
+    assert server.db.submit_message(bad).wait(5) is False
+    response = client.post(f'/message/send/{roomname}', json={'message': message(roomname, username)})
+    assert response.status_code == 200
+    assert response.get_json()['offset'] == 0
+
+
+def test_durable_send_times_out(server, client, make_room, monkeypatch):
+    monkeypatch.setattr(server, 'SEND_TIMEOUT', 0.1)
+    roomname, (username,) = make_room()
+    with server.db.pool.writer():  # The message writer cannot commit meanwhile
+        response = client.post(f'/message/send/{roomname}', json={'message': message(roomname, username)})
+        assert response.status_code == 503
+    # It is still stored once the writer gets its turn
+    assert client.get(f'/message/get/{roomname}?wait=5').get_json()['last_offset'] == 0
+
+
+@pytest.mark.parametrize('wait', ['nan', 'inf', '-inf', '-1'])
+def test_get_with_invalid_wait(client, wait):
+    assert client.get(f'/message/get/welcome?since=100&wait={wait}').status_code == 422
+
+
+@pytest.mark.parametrize('since, status', [(-10 ** 23, 200), (-5, 200), (2 ** 63 - 1, 200), (2 ** 63, 422),
+                                           (10 ** 23, 422)])
+def test_since_out_of_range(client, archived_room, since, status):
+    response = client.get(f'/message/get/{archived_room}?since={since}')
+    assert response.status_code == status
+    many = client.post('/message/get_many', json={'rooms': {archived_room: since}})
+    assert many.status_code == status
+    if status == 200:
+        expected = [] if since > 0 else list(range(10))
+        assert [m['offset'] for m in response.get_json()['messages']] == expected
+        assert [m['offset'] for m in many.get_json()['rooms'][0]['messages']] == expected
+
+
+def test_limit_out_of_range(client, archived_room):
+    assert client.get(f'/message/get/{archived_room}?limit={2 ** 64}').status_code == 422
+    assert client.post(f'/message/get_many?limit={2 ** 64}', json={'rooms': {archived_room: -1}}).status_code == 422
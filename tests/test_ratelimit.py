@@ -0,0 +1,76 @@
+'''
+Rate limits and backpressure of the send routes
+'''
+import types
+
+import pytest
+
+import ratelimit
+from conftest import message
+from ratelimit import RateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    ''' The time seen by the rate limiter, moved by hand '''
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(ratelimit, 'time', types.SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_burst_then_rejected(clock):
+    limiter = RateLimiter(user=(2, 3))
+    for _ in range(3):
+        assert limiter.acquire({('user', 'a'): 1}) == (None, 0)
+    assert limiter.acquire({('user', 'a'): 1}) == ('user', 0.5)
+    assert limiter.acquire({('user', 'b'): 1}) == (None, 0)  # Every key has its own bucket
+    clock.now += 0.5
+    assert limiter.acquire({('user', 'a'): 1}) == (None, 0)
+    assert limiter.acquire({('user', 'a'): 1}) == ('user', 0.5)
+
+
+def test_request_larger_than_burst(clock):
+    limiter = RateLimiter(user=(1, 3))
+    assert limiter.acquire({('user', 'a'): 1}) == (None, 0)
+    # Not admitted until the bucket is full again
+    assert limiter.acquire({('user', 'a'): 5}) == ('user', 1)
+    clock.now += 1
+    assert limiter.acquire({('user', 'a'): 5}) == (None, 0)
+    # Admitted with the bucket full, it is left in debt: 2 tokens short of one
+    assert limiter.acquire({('user', 'a'): 1}) == ('user', 3)
+    clock.now += 3
+    assert limiter.acquire({('user', 'a'): 1}) == (None, 0)
+
+
+def test_all_or_none_of_the_buckets(clock):
+    limiter = RateLimiter(user=(1, 10), room=(1, 2), other=None)
+    assert limiter.acquire({('user', 'a'): 2, ('room', 'r'): 2, ('other', 'x'): 100}) == (None, 0)
+    assert limiter.acquire({('user', 'a'): 1, ('room', 'r'): 1}) == ('room', 1)
+    assert limiter.acquire({('user', 'a'): 8}) == (None, 0)  # The rejected request took nothing from it
+    assert limiter.stats() == {'user': 1, 'room': 1}
+
+
+def test_send_over_the_user_limit(server, client, make_room, monkeypatch, clock):
+    monkeypatch.setattr(server, 'send_limiter', RateLimiter(user=(0.5, 2)))
+    roomname, (username,) = make_room()
+    for _ in range(2):
+        response = client.post(f'/message/send/{roomname}?durable=0', json={'message': message(roomname, username)})
+        assert response.status_code == 200
+    response = client.post(f'/message/send/{roomname}', json={'message': message(roomname, username)})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    batch = [message(roomname, username) for _ in range(3)]
+    clock.now += 4
+    assert client.post('/message/send_many', json={'messages': batch}).status_code == 200
+    response = client.post('/message/send_many', json={'messages': batch[:1]})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '4'  # The batch left the bucket one token in debt
+
+
+def test_send_while_the_writer_is_behind(server, client, make_room, monkeypatch):
+    monkeypatch.setattr(server, 'MAX_WRITE_BACKLOG', 0)
+    roomname, (username,) = make_room()
+    response = client.post(f'/message/send/{roomname}', json={'message': message(roomname, username)})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == str(server.BACKLOG_RETRY_AFTER)
+    assert client.get(f'/message/get/{roomname}').get_json()['messages'] == []
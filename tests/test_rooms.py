@@ -0,0 +1,24 @@
+'''
+Creating and deleting rooms
+'''
+from conftest import message
+
+
+def test_recreated_room_starts_empty(server, client, make_room):
+    roomname, (username,) = make_room()
+    for i in range(10):
+        response = client.post(f'/message/send/{roomname}', json={'message': message(roomname, username, f'{i}')})
+        assert response.status_code == 200
+    assert server.db.archive_messages(roomname, upto=6) == 7
+    assert client.get(f'/room/delete/{roomname}').status_code == 200
+
+    assert client.post(f'/room/create/{roomname}').status_code == 200
+    answer = client.get(f'/message/get/{roomname}').get_json()
+    assert answer == {'roomname': roomname, 'last_offset': -1, 'messages': []}
+    assert server.db.get_room_messages(roomname) == []
+    # The old members are not members anymore, they can join again
+    assert username not in server.cached_rooms[roomname]
+    assert client.get(f'/joined_room/join/{roomname}?username={username}').status_code == 200
+    response = client.post(f'/message/send/{roomname}', json={'message': message(roomname, username)})
+    assert response.status_code == 200
+    assert response.get_json()['offset'] == 0